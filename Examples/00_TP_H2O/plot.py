@@ -8,39 +8,35 @@ Created on Thu Nov 22 10:14:48 2018
 
 
 from matplotlib import pylab as plt
+import importlib.util
+import os
 import numpy as np
-import pickle
 
 
-
-
-def GaussBroad(X,Y,xmin,xmax,Npts,FWHM=1.5,FWHM2=1.5):
+def loadModule(name):
     """
-    Function to broad a stick spectrum
+    psixas module name loaded by path: importing it through the psixas
+    package would import psi4 and the compiled plugin with it
     """
-    XVals = np.array([X])[np.where(np.array([X])<=xmax)]
-    YVals = np.array([Y])[np.where(np.array([X])<=xmax)]
-
-    Xgrid = np.linspace(xmin,xmax,Npts)
-    Ygrid = np.zeros(len(Xgrid))
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", name+".py")
+    spec = importlib.util.spec_from_file_location("psixas_"+name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
-    m =(FWHM2-FWHM)/(xmax-xmin)
-    n =FWHM-m*xmin
+ksbroad      = loadModule("ksbroad")
+broaden      = ksbroad.broaden
+linearFWHM   = ksbroad.linearFWHM
+SpectrumFile = loadModule("ksspectrum").SpectrumFile
 
-    for i,j in zip(XVals,YVals):
-        sigma = (m*i+n)/(2*np.sqrt(2*np.log(2)))
-        tmpY  = 1/(np.sqrt(2*np.pi)*np.float(sigma))*np.exp(-(Xgrid-np.float(i))**2/(2*np.float(sigma)**2))
-        if np.max(tmpY)>0:
-            tmpY /=np.max(tmpY)
-            tmpY *= j
-            Ygrid += tmpY
 
-    return Xgrid,Ygrid
 
 
-spec = pickle.load(open("WATER_b.spectrum","rb"))
+sf   = SpectrumFile("WATER.spectrum")
+spec = sf.spectrum(sf.find(spin="b")[0])
 Ints = spec["En"]*27.211385*(spec["Dx"]**2+spec["Dy"]**2+spec["Dz"]**2)
-X,Y  = GaussBroad(spec["En"]*27.211385,Ints,535,550,1000,0.8,0.8)
+X    = np.linspace(535,550,1000)
+Y    = broaden(spec["En"]*27.211385,Ints,X,fwhm=linearFWHM(0.8,0.8,535,550),norm="height")
 
 scale = 1/np.max(Y)
 
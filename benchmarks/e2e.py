@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks: MODE GS+EX+SPEC with the installed psi4
+
+Every case runs in a fresh python process in its own scratch directory,
+so the peak memory of one case is not inflated by the previous ones.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+MOLECULES = {
+    "H2O": """
+O   0.27681793323501      0.00000014791107      0.00000000000000
+H   0.86159097690242      0.76505117501585      0.00000000000000
+H   0.86159108986257     -0.76505132292693      0.00000000000000
+symmetry c1
+""",
+    "CO": """
+C   0.00000000000000      0.00000000000000      0.00000000000000
+O   0.00000000000000      0.00000000000000      1.12830000000000
+symmetry c1
+""",
+    "NH3": """
+N   0.00000000000000      0.00000000000000      0.11680000000000
+H   0.00000000000000      0.94010000000000     -0.27260000000000
+H   0.81410000000000     -0.47000000000000     -0.27260000000000
+H  -0.81410000000000     -0.47000000000000     -0.27260000000000
+symmetry c1
+""",
+}
+
+BASIS = ["def2-SVP", "def2-TZVP"]
+
+# executed in the child process, prints one JSON line with the results
+SCRIPT = """
+import json, time, resource
+import psi4
+import psixas
+
+psi4.set_output_file("bench.out", False)
+psi4.set_memory({memory!r})
+psi4.set_num_threads({threads:d})
+mol = psi4.geometry({geometry!r})
+psi4.set_options({{"basis": {basis!r}, "reference": "uks", "scf_type": "MEM_DF"}})
+psi4.set_module_options("psixas", {{"prefix": "BENCH", "mode": "GS+EX+SPEC",
+                                    "orbs": [0], "occs": [0.5], "spin": ["b"],
+                                    "ovl": ["T"], "freeze": ["T"], "damp": 0.2}})
+t0 = time.perf_counter()
+psi4.energy("psixas", functional={func!r})
+print("BENCH " + json.dumps({{
+    "time"          : time.perf_counter() - t0,
+    "gs_iterations" : psi4.core.scalar_variable("GS ITERATIONS"),
+    "ex_iterations" : psi4.core.scalar_variable("EX ITERATIONS"),
+    "energy"        : psi4.core.scalar_variable("CURRENT ENERGY"),
+    "peak_mem"      : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0}}))
+"""
+
+
+def runCase(name, basis, func="PBE", memory="2 GB", threads=1):
+    """
+    Runs one molecule/basis combination, returns the parsed results
+    """
+    script = SCRIPT.format(geometry=MOLECULES[name], basis=basis, func=func,
+                           memory=memory, threads=threads)
+    with tempfile.TemporaryDirectory(prefix="psixas_bench_") as tmp:
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", script], cwd=tmp, env=os.environ.copy(),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        wall = time.perf_counter() - t0
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH "):
+            result = json.loads(line[6:])
+            result["wall"] = wall
+            return result
+    raise Exception("benchmark {}/{} failed:\n{}".format(name, basis, proc.stdout[-2000:]))
+
+
+def runE2E(molecules=None, basis=None, out=print, **kwargs):
+    """
+    Runs every molecule with every basis set. Returns a dict
+    "molecule/basis" -> results of runCase
+    """
+    results = {}
+    for name in (molecules or sorted(MOLECULES)):
+        for bas in (basis or BASIS):
+            r = runCase(name, bas, **kwargs)
+            results["{}/{}".format(name, bas)] = r
+            out("{:<6} {:<10} {:10.2f} s {:4.0f} GS {:4.0f} EX {:10.2f} MB".format(
+                name, bas, r["time"], r["gs_iterations"], r["ex_iterations"], r["peak_mem"]))
+    return results
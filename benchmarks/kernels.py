@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the SCF and spectrum kernels on synthetic matrices
+
+Every kernel is timed on a random symmetric "Fock" matrix, a positive
+definite "overlap" matrix and orbitals that are orthonormal in that
+metric, so the kernels see the same shapes and conditioning as in a real
+calculation of the same nbf without running psi4.
+"""
+import importlib.util
+import os
+import time
+import tracemalloc
+import numpy as np
+
+
+def loadKernels():
+    """
+    kslinalg.py loaded by path: importing it through the psixas package
+    would import psi4 and the compiled plugin with it
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "kslinalg.py")
+    spec = importlib.util.spec_from_file_location("psixas_kslinalg", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+_kslinalg = loadKernels()
+diag_H            = _kslinalg.diag_H
+DIIS_helper       = _kslinalg.DIIS_helper
+OrbitalTracker    = _kslinalg.OrbitalTracker
+freezeShift       = _kslinalg.freezeShift
+transitionDipoles = _kslinalg.transitionDipoles
+
+
+def syntheticSystem(nbf, seed=0):
+    """
+    S (overlap), A (S^-1/2), F (Fock), C (S-orthonormal orbitals) and three
+    dipole matrices of dimension nbf
+    """
+    rng = np.random.RandomState(seed)
+    X = rng.standard_normal((nbf, nbf))/np.sqrt(nbf)
+    S = np.eye(nbf) + 0.1*(X + X.T)/2.0
+    S = S @ S.T
+    e, U = np.linalg.eigh(S)
+    A = (U*e**-0.5) @ U.T
+    F = rng.standard_normal((nbf, nbf))
+    F = (F + F.T)/2.0
+    C, eps = diag_H(F, A)
+    D = [(M + M.T)/2.0 for M in rng.standard_normal((3, nbf, nbf))]
+    return {"S": S, "A": A, "F": F, "C": C, "eps": eps, "D": D}
+
+
+def timeit(func, repeat=5):
+    """
+    Best wall time of repeat calls and the peak memory (MB) traced
+    during one call
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]/1024.0**2
+    tracemalloc.stop()
+    return best, peak
+
+
+def kernelCases(sys, nocc):
+    """
+    name -> callable for every kernel
+    """
+    S, A, F, C, D = sys["S"], sys["A"], sys["F"], sys["C"], sys["D"]
+    nbf = S.shape[0]
+
+    diis = DIIS_helper()
+    for n in range(6):
+        diis.add(F + 1e-3*n, F - 1e-3*n)
+
+    def diisStep():
+        diis.add(F, F)
+        diis.extrapolate()
+
+    orbitals = [{"orb": 0, "spin": "b", "occ": 0.5, "frz": True, "DoOvl": True, "C": C[:, 0]}]
+    tracker = OrbitalTracker(orbitals, S)
+    occ = np.zeros(nbf)
+
+    shifted = list(range(nocc, nbf))
+
+    return {"diag_H"            : lambda: diag_H(F, A),
+            "diag_H_subset"     : lambda: diag_H(F, A, nroots=min(nbf, nocc + 10)),
+            "DIIS_add_extrap"   : diisStep,
+            "OrbitalTracker"    : lambda: tracker.update(C, occ, "b"),
+            "freezeShift"       : lambda: freezeShift(F, C, S, [0], shifted, 10.0),
+            "transitionDipoles" : lambda: transitionDipoles(C, D, [0], shifted)}
+
+
+def runKernels(sizes=(100, 300, 1000, 3000), repeat=5, out=print):
+    """
+    Runs all kernels for every nbf in sizes. Returns a dict
+    "kernel/nbf" -> {"time": s, "peak_mem": MB}
+    """
+    results = {}
+    for nbf in sizes:
+        sys = syntheticSystem(nbf)
+        # big matrices are slow enough that a few repeats suffice
+        nrep = repeat if nbf < 1000 else max(1, repeat//2)
+        for name, func in kernelCases(sys, max(1, nbf//10)).items():
+            t, mem = timeit(func, nrep)
+            results["{}/{}".format(name, nbf)] = {"time": t, "peak_mem": mem}
+            out("{:<20} {:>6d} {:12.6f} s {:10.2f} MB".format(name, nbf, t, mem))
+    return results
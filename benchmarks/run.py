@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+psixas benchmark driver
+
+    export PYTHONPATH=/path/to/psi4Plugins
+    python benchmarks/run.py --kernels --e2e -o results.json
+    python benchmarks/run.py --kernels -o new.json --baseline results.json
+
+Writes a JSON results file. With --baseline, every time and peak memory is
+compared to the stored run and the script exits with status 1 if one got
+worse by more than --tolerance, or if an iteration count went up.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def compare(results, baseline, tolerance, floor=1.0E-3, out=print):
+    """
+    Returns the list of regressions of results with respect to baseline.
+    Time differences below floor seconds are taken as noise.
+    """
+    regressions = []
+    for section in ["kernels", "e2e"]:
+        for case, new in results.get(section, {}).items():
+            old = baseline.get(section, {}).get(case)
+            if old is None:
+                continue
+            for key, value in new.items():
+                if key not in old or not isinstance(value, (int, float)) or key == "energy":
+                    continue
+                ref = old[key]
+                if key.endswith("iterations"):
+                    bad = value > ref
+                else:
+                    bad = value > ref*(1.0 + tolerance)
+                    if key == "time" and value - ref < floor:
+                        bad = False
+                ratio = value/ref if ref else float("inf")
+                flag = "REGRESSION" if bad else ""
+                out("{:<8} {:<28} {:<14} {:12.4f} {:12.4f} {:8.2f} {}".format(section, case, key, ref, value, ratio, flag))
+                if bad:
+                    regressions.append((section, case, key, ref, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="psixas benchmarks")
+    parser.add_argument("--kernels", action="store_true", help="run the kernel microbenchmarks")
+    parser.add_argument("--e2e", action="store_true", help="run the end-to-end psi4 calculations")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 300, 1000, 3000], help="nbf of the kernel benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="repeats per kernel, the best time is kept")
+    parser.add_argument("--molecules", nargs="+", default=None, help="molecules of the end-to-end runs")
+    parser.add_argument("--basis", nargs="+", default=None, help="basis sets of the end-to-end runs")
+    parser.add_argument("--threads", type=int, default=1, help="psi4 threads of the end-to-end runs")
+    parser.add_argument("-o", "--output", default="results.json", help="results file")
+    parser.add_argument("--baseline", default=None, help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative increase of time/memory")
+    parser.add_argument("--floor", type=float, default=1.0E-3, help="time differences below this (s) are ignored")
+    args = parser.parse_args(argv)
+
+    if not (args.kernels or args.e2e):
+        args.kernels = True
+
+    results = {"meta": {"date"     : time.strftime("%Y-%m-%d %H:%M:%S"),
+                        "host"     : platform.node(),
+                        "python"   : platform.python_version(),
+                        "platform" : platform.platform()}}
+
+    if args.kernels:
+        from kernels import runKernels
+        print("Kernels:")
+        results["kernels"] = runKernels(args.sizes, args.repeat)
+    if args.e2e:
+        from e2e import runE2E
+        print("End-to-end:")
+        results["e2e"] = runE2E(args.molecules, args.basis, threads=args.threads)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print("{} written.".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nComparison with {} (tolerance {:.0%}):".format(args.baseline, args.tolerance))
+        regressions = compare(results, baseline, args.tolerance, args.floor)
+        if regressions:
+            print("\n{:d} regression(s) found.".format(len(regressions)))
+            return 1
+        print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
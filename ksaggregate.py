@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregation of the stick spectra of several core-hole sites
+
+Every site (block of a spectrum file) is shifted by its own Delta-KS
+energy and the shifted sticks of all sites are broadened together, either
+summed or resolved by site. Shifts, stick selection and broadening are
+array operations over all blocks at once.
+
+ALIGN IONIZATION: the initial orbital energy -epsI is placed at the Delta-KS
+                  energy E(EX) - E(GS) of the site (full core hole runs, TP)
+ALIGN EXCITATION: the lowest stick of the site is placed at E(EX) - E(GS)
+                  (excited state runs with the electron in the LUMO)
+ALIGN NONE:       no shifts
+"""
+import numpy as np
+from .ksbroad import broaden, HARTREE2EV
+from .ksspectrum import SpectrumFile
+
+
+ALIGN_MODES = ["NONE", "IONIZATION", "EXCITATION"]
+
+
+def alignmentShifts(sf, blocks, align="IONIZATION", gsE=None):
+    """
+    Shift (Hartree) of every stick of blocks.
+
+    Parameters
+    ----------
+    sf : SpectrumFile
+    blocks : list of int
+    align : str
+        NONE, IONIZATION or EXCITATION.
+    gsE : float
+        Ground state energy, default the gs_energy stored with every block.
+    """
+    bidx = sf.blockIndex(blocks)
+    if align == "NONE" or len(bidx) == 0:
+        return np.zeros(len(bidx))
+    if align not in ALIGN_MODES:
+        raise Exception("Unknown alignment {}, use one of {}".format(align, ALIGN_MODES))
+
+    meta = [sf.meta(b) for b in blocks]
+    for b, m in zip(blocks, meta):
+        if "energy" not in m or (gsE is None and "gs_energy" not in m):
+            raise Exception("Block {} of {} has no excited/ground state energy to align".format(b, sf.filename))
+    dE = np.array([m["energy"] - (m["gs_energy"] if gsE is None else gsE) for m in meta])
+
+    # position of every stick's block in blocks
+    pos = np.repeat(np.arange(len(blocks)), sf.nsticks(blocks))
+    if align == "IONIZATION":
+        epsI = sf.column("epsI", blocks)
+        return dE[pos] + epsI
+    En    = sf.column("En", blocks)
+    start = np.concatenate([[0], np.cumsum(sf.nsticks(blocks))[:-1]])
+    E0    = np.minimum.reduceat(En, start)
+    return (dE - E0)[pos]
+
+
+def AggregateSpectra(filename, grid=None, align="IONIZATION", gsE=None, blocks=None,
+                     resolved=False, units="eV", **kwargs):
+    """
+    Delta-KS aligned, broadened spectrum of all (or the given) blocks of a
+    spectrum file.
+
+    Parameters
+    ----------
+    filename : str
+        Spectrum file, e.g. PREFIX_sites.spectrum.
+    grid : ndarray
+        Energy grid in units, default 2000 points around the sticks.
+    align, gsE : see alignmentShifts
+    resolved : bool
+        Also return one spectrum per site (meta "site").
+    kwargs : passed to ksbroad.broaden (fwhm, shape, fwhmL, norm, method)
+
+    Returns
+    -------
+    result : dict
+        grid, total, the shifted sticks (En, f, block) and with resolved
+        also sites and site_spectra (nsites x len(grid)).
+    """
+    sf = SpectrumFile(filename)
+    if blocks is None:
+        blocks = list(range(len(sf)))
+    blocks = [b for b in blocks if sf.nsticks([b])[0] > 0]
+    if len(blocks) == 0:
+        raise Exception("No sticks to aggregate in {}".format(filename))
+
+    scale = HARTREE2EV if units == "eV" else 1.0
+    En = (sf.column("En", blocks) + alignmentShifts(sf, blocks, align, gsE))*scale
+    f  = sf.column("f", blocks)
+
+    if grid is None:
+        fwhm = kwargs.get("fwhm", 1.0)
+        pad  = 5.0*(np.max(fwhm) if not callable(fwhm) else 1.0)
+        grid = np.linspace(En.min() - pad, En.max() + pad, 2000)
+    grid = np.asarray(grid, dtype=float)
+
+    result = {"grid"  : grid,
+              "total" : broaden(En, f, grid, **kwargs),
+              "En"    : En,
+              "f"     : f,
+              "block" : sf.blockIndex(blocks)}
+
+    if resolved:
+        # one padded row of sticks per site, broadened in one batched call
+        labels = [str(sf.meta(b).get("site", b)) for b in blocks]
+        sites = list(dict.fromkeys(labels))
+        site  = np.repeat([sites.index(l) for l in labels], sf.nsticks(blocks))
+        order = np.argsort(site, kind="stable")
+        count = np.bincount(site, minlength=len(sites))
+        col   = np.arange(len(site)) - np.repeat(np.cumsum(count) - count, count)
+        Es = np.full((len(sites), max(1, count.max())), np.median(En))
+        Is = np.zeros(Es.shape)
+        Es[site[order], col] = En[order]
+        Is[site[order], col] = f[order]
+        result["sites"]        = sites
+        result["site_spectra"] = broaden(Es, Is, grid, **kwargs)
+    return result
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Broadening of stick spectra
+
+All sticks of all spectra are evaluated as array operations, in chunks of
+sticks so that the temporary (sticks x grid points) array stays bounded.
+With a constant width on a uniform grid the sticks are instead binned onto
+the grid and convolved with the line shape by FFT, which is independent of
+the number of sticks.
+
+>>> grid = np.linspace(530, 550, 2000)
+>>> Y = broadenSpectrum(spec["b"], grid, fwhm=linearFWHM(0.8, 2.0, 535, 545))
+"""
+import numpy as np
+try:
+    from scipy.special import wofz
+except ImportError:
+    wofz = None
+
+
+HARTREE2EV = 27.211385
+
+SHAPES = ["GAUSS", "LORENTZ", "VOIGT"]
+
+FWHM2SIGMA = 1.0/(2.0*np.sqrt(2.0*np.log(2.0)))
+
+
+def linearFWHM(fwhm1, fwhm2, e1, e2):
+    """
+    Width changing linearly from fwhm1 at e1 to fwhm2 at e2, as used
+    for the example spectra
+    """
+    m = (fwhm2 - fwhm1)/(e2 - e1)
+    return lambda E: fwhm1 + m*(np.asarray(E) - e1)
+
+
+def _widths(fwhm, En):
+    """
+    fwhm (number, array like En or callable of the energy) as array like En
+    """
+    if callable(fwhm):
+        fwhm = fwhm(En)
+    return np.broadcast_to(np.asarray(fwhm, dtype=float), En.shape)
+
+
+def lineshape(x, fwhm, shape="GAUSS", fwhmL=None):
+    """
+    Area normalized line shape at the offsets x.
+
+    Parameters
+    ----------
+    x : ndarray
+        Distance from the stick position.
+    fwhm : float or ndarray
+        FWHM of the profile (Gaussian part of VOIGT), broadcast with x.
+    shape : str
+        GAUSS, LORENTZ or VOIGT.
+    fwhmL : float or ndarray
+        Lorentzian FWHM of VOIGT.
+    """
+    shape = shape.upper()
+    if shape == "GAUSS":
+        sigma = fwhm*FWHM2SIGMA
+        return np.exp(-0.5*(x/sigma)**2)/(sigma*np.sqrt(2.0*np.pi))
+    if shape == "LORENTZ":
+        g = 0.5*fwhm
+        return g/(np.pi*(x*x + g*g))
+    if shape == "VOIGT":
+        if fwhmL is None:
+            raise Exception("VOIGT broadening needs the Lorentzian width fwhmL")
+        if wofz is None:
+            return _pseudoVoigt(x, fwhm, fwhmL)
+        sigma = fwhm*FWHM2SIGMA
+        z = (x + 0.5j*fwhmL)/(sigma*np.sqrt(2.0))
+        return wofz(z).real/(sigma*np.sqrt(2.0*np.pi))
+    raise Exception("Unknown line shape {}, use one of {}".format(shape, SHAPES))
+
+
+def _pseudoVoigt(x, fwhmG, fwhmL):
+    """
+    Thompson-Cox-Hastings approximation of the Voigt profile, used if
+    scipy is not available
+    """
+    f = (fwhmG**5 + 2.69269*fwhmG**4*fwhmL + 2.42843*fwhmG**3*fwhmL**2
+         + 4.47163*fwhmG**2*fwhmL**3 + 0.07842*fwhmG*fwhmL**4 + fwhmL**5)**0.2
+    r = fwhmL/f
+    eta = 1.36603*r - 0.47719*r**2 + 0.11116*r**3
+    return eta*lineshape(x, f, "LORENTZ") + (1.0 - eta)*lineshape(x, f, "GAUSS")
+
+
+def _uniform(grid):
+    d = np.diff(grid)
+    return len(grid) > 2 and np.allclose(d, d[0], rtol=1.0E-6, atol=0.0)
+
+
+def broaden(En, I, grid, fwhm=1.0, shape="GAUSS", fwhmL=None, norm="area", method="auto", chunk=2**22):
+    """
+    Broadens stick spectra onto grid.
+
+    Parameters
+    ----------
+    En, I : ndarray
+        Stick positions and intensities, shape (..., nsticks). Leading
+        dimensions are independent spectra that are broadened together.
+    grid : ndarray
+        Energies of the broadened spectrum, same unit as En.
+    fwhm, fwhmL : float, ndarray or callable
+        Widths; a callable is evaluated at the stick positions.
+    norm : str
+        "area": every stick keeps its intensity as area,
+        "height": every stick keeps its intensity as peak height.
+    method : str
+        "direct", "fft" (constant widths on a uniform grid only) or "auto".
+    chunk : int
+        Maximum number of elements of the temporary profile array.
+
+    Returns
+    -------
+    Y : ndarray
+        Shape (..., len(grid)).
+    """
+    En   = np.asarray(En, dtype=float)
+    I    = np.broadcast_to(np.asarray(I, dtype=float), En.shape)
+    grid = np.asarray(grid, dtype=float)
+
+    W  = _widths(fwhm, En)
+    WL = None if fwhmL is None else _widths(fwhmL, En)
+    if norm == "height":
+        I = I/lineshape(np.zeros(En.shape), W, shape, WL)
+    elif norm != "area":
+        raise Exception("Unknown normalization {}, use area or height".format(norm))
+
+    const = (not callable(fwhm) and np.ndim(fwhm) == 0
+             and (fwhmL is None or (not callable(fwhmL) and np.ndim(fwhmL) == 0)))
+    if method == "auto":
+        # binning onto the grid is accurate if the line is much wider than the spacing
+        method = "fft" if const and _uniform(grid) and fwhm > 5.0*(grid[1] - grid[0]) else "direct"
+
+    lead = En.shape[:-1]
+    En   = En.reshape(-1, En.shape[-1])
+    I    = I.reshape(En.shape)
+    if method == "fft":
+        if not (const and _uniform(grid)):
+            raise Exception("FFT broadening needs constant widths and a uniform grid")
+        Y = _broadenFFT(En, I, grid, fwhm, shape, fwhmL)
+    elif method == "direct":
+        Y = _broadenDirect(En, I, grid, W.reshape(En.shape), shape,
+                           None if WL is None else WL.reshape(En.shape), chunk)
+    else:
+        raise Exception("Unknown broadening method {}".format(method))
+    return Y.reshape(lead + grid.shape)
+
+
+def _broadenDirect(En, I, grid, W, shape, WL, chunk):
+    nspec, nstick = En.shape
+    Y = np.zeros((nspec, len(grid)))
+    step = max(1, chunk//max(1, nspec*len(grid)))
+    for s in range(0, nstick, step):
+        e = slice(s, s + step)
+        x = grid[None, None, :] - En[:, e, None]
+        P = lineshape(x, W[:, e, None], shape, None if WL is None else WL[:, e, None])
+        Y += np.matmul(I[:, None, e], P)[:, 0]
+    return Y
+
+
+def _broadenFFT(En, I, grid, fwhm, shape, fwhmL):
+    nspec = En.shape[0]
+    n  = len(grid)
+    h  = grid[1] - grid[0]
+
+    # linear binning: every stick is split onto its two neighbouring grid
+    # points, conserving its area and position; sticks off the grid are dropped
+    t   = (En - grid[0])/h
+    j   = np.floor(t).astype(int)
+    w   = t - j
+    row = np.arange(nspec)[:, None]*n
+    H   = np.zeros(nspec*n)
+    for jj, ww in [(j, 1.0 - w), (j + 1, w)]:
+        ok = (jj >= 0) & (jj < n)
+        H += np.bincount((row + jj)[ok], weights=(I*ww)[ok], minlength=nspec*n)
+    H = H.reshape(nspec, n)/h
+
+    # line shape on offsets -n..n, zero padded against wrap around
+    m = 2*n
+    x = h*np.concatenate([np.arange(0, n), np.arange(-n, 0)])
+    K = lineshape(x, fwhm, shape, fwhmL)*h
+    Y = np.fft.irfft(np.fft.rfft(H, m, axis=1)*np.fft.rfft(K, m), m, axis=1)
+    return Y[:, :n]
+
+
+def stickIntensities(spec):
+    """
+    Oscillator strengths of a spectrum dict written by CalcSpec
+    """
+    if "f" in spec:
+        return np.asarray(spec["f"])
+    En = np.asarray(spec["En"])
+    return 2.0/3.0*En*(np.asarray(spec["Dx"])**2 + np.asarray(spec["Dy"])**2 + np.asarray(spec["Dz"])**2)
+
+
+def broadenSpectrum(spec, grid, units="eV", **kwargs):
+    """
+    Broadened spectrum of a CalcSpec spectrum dict (energies in Hartree)
+    on grid (in units, eV or Hartree). kwargs are passed to broaden.
+    """
+    En = np.asarray(spec["En"])
+    if units == "eV":
+        En = En*HARTREE2EV
+    return broaden(En, stickIntensities(spec), grid, **kwargs)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache for AO integral matrices
+
+Entries are content addressed: the key is a hash of the geometry, the
+orbital and auxiliary basis sets and the DFT grid settings. Every entry is
+a directory of .npy files that are read back memory-mapped. The total size
+of the cache is capped and the least recently used entries are evicted.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import psi4
+
+
+GRID_OPTIONS = ["DFT_SPHERICAL_POINTS", "DFT_RADIAL_POINTS", "DFT_RADIAL_SCHEME",
+                "DFT_NUCLEAR_SCHEME", "DFT_PRUNING_SCHEME", "DFT_BASIS_TOLERANCE"]
+
+
+def cache_key(mol, basisset, auxname):
+    """
+    Hash of everything the cached matrices depend on
+    """
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(np.asarray(mol.geometry()), dtype=np.float64).tobytes())
+    h.update(np.array([mol.Z(i) for i in range(mol.natom())], dtype=np.float64).tobytes())
+    h.update(basisset.name().encode())
+    h.update(basisset.genbas().encode())
+    h.update(str(basisset.has_puream()).encode())
+    h.update(str(auxname).encode())
+    for opt in GRID_OPTIONS:
+        h.update("{}={}".format(opt, psi4.core.get_global_option(opt)).encode())
+    return h.hexdigest()
+
+
+class IntegralCache(object):
+    """
+    LRU-evicted directory of memory-mapped .npy files.
+
+    Parameters
+    ----------
+    path : str
+        Root directory of the cache, created if needed.
+    max_size : int
+        Maximum total size of the cache in MB.
+    """
+
+    def __init__(self, path, max_size=2048):
+        self.path     = os.path.abspath(path)
+        self.max_size = int(max_size) * 1024**2
+        os.makedirs(self.path, exist_ok=True)
+
+    @classmethod
+    def from_options(cls):
+        """
+        Cache configured by the CACHE_DIR/CACHE_MAX_SIZE options, or None if
+        CACHE_DIR is not set.
+        """
+        path = psi4.core.get_local_option("PSIXAS", "CACHE_DIR")
+        if not path:
+            return None
+        return cls(path, psi4.core.get_local_option("PSIXAS", "CACHE_MAX_SIZE"))
+
+    def _file(self, key, name):
+        return os.path.join(self.path, key, name + ".npy")
+
+    def get(self, key, name):
+        """
+        Returns the cached array (memory-mapped, read only) or None.
+        """
+        fname = self._file(key, name)
+        if not os.path.isfile(fname):
+            return None
+        # mark the entry as recently used
+        os.utime(os.path.join(self.path, key))
+        return np.load(fname, mmap_mode="r")
+
+    def put(self, key, name, array):
+        """
+        Stores array atomically and evicts old entries if the cache is full.
+        """
+        entry = os.path.join(self.path, key)
+        os.makedirs(entry, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=entry, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp, self._file(key, name))
+        os.utime(entry)
+        self.evict(keep=key)
+
+    def fetch(self, key, name, compute):
+        """
+        Returns the cached array or computes, stores and returns it.
+        """
+        array = self.get(key, name)
+        if array is None:
+            array = np.asarray(compute())
+            self.put(key, name, array)
+        return array
+
+    def size(self):
+        return sum(s for _, _, s in self._entries())
+
+    def _entries(self):
+        entries = []
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), entry, size))
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits in max_size.
+        The entry keep is never removed.
+        """
+        entries = sorted(self._entries())
+        total = sum(s for _, _, s in entries)
+        for _, entry, size in entries:
+            if total <= self.max_size:
+                break
+            if keep is not None and os.path.basename(entry) == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Session-wide context shared by the GS, LOC, EX and SPEC stages
+
+The wavefunction, integrals, superfunctional, DFT grid and JK object are
+built once per energy('psixas') call and handed to every stage, so that a
+combined run (e.g. MODE GS+EX+SPEC) pays the setup cost only once. If
+CACHE_DIR is set, the AO matrices are also kept on disk between runs.
+"""
+import psi4
+import numpy as np
+from .kscache import IntegralCache, cache_key
+from .kshelper import DIIS_helper, ADIIS_helper
+from .ksmemory import planJK, printPlan, requestedSCFType, DF_TYPES
+
+
+class KSContext(object):
+    """
+    Container for the objects every psixas stage needs.
+
+    The one-electron integrals are computed on construction, the more
+    expensive objects (DF basis, JK, DFT grid, dipole integrals) are built
+    on first use, so a SPEC-only run never builds a JK object.
+    """
+
+    def __init__(self, mol, func, basis=None):
+        self.mol   = mol
+        self.func  = func
+        self.basis = basis if basis else psi4.core.get_global_option('BASIS')
+
+        self.wfn   = psi4.core.Wavefunction.build(mol, self.basis)
+        self.mints = psi4.core.MintsHelper(self.wfn.basisset())
+
+        self.nbf    = self.wfn.nso()
+        self.nalpha = self.wfn.nalpha()
+        self.nbeta  = self.wfn.nbeta()
+        self.Enuc   = mol.nuclear_repulsion_energy()
+
+        self.cache = IntegralCache.from_options()
+        if self.cache is not None:
+            self.key = cache_key(mol, self.wfn.basisset(),
+                                 psi4.core.get_global_option("DF_BASIS_SCF"))
+
+        self.S = self._fetch("S", lambda: self.mints.ao_overlap())
+        self.T = self._fetch("T", lambda: self.mints.ao_kinetic())
+        self.V = self._fetch("V", lambda: self.mints.ao_potential())
+        self.H = self.T + self.V
+
+        if self.wfn.basisset().has_ECP():
+            self.H += self._fetch("ECP", lambda: self.mints.ao_ecp())
+
+        self.A = self._fetch("A", self._build_A)
+
+        self._sup    = None
+        self._aux    = None
+        self._jk     = None
+        self._Vpot   = {}
+        self._plan   = None
+        self._dipole = None
+
+        # Fock and J/K of the converged ground state (WARMSTART)
+        self.gs_state = None
+
+    def _fetch(self, name, compute):
+        """
+        Get a matrix from the integral cache, or compute it if caching is off
+        """
+        if self.cache is None:
+            return np.asarray(compute())
+        return self.cache.fetch(self.key, name, lambda: np.asarray(compute()))
+
+    def _build_A(self):
+        A = self.mints.ao_overlap()
+        A.power(-0.5, 1.e-16)
+        return np.asarray(A)
+
+    @property
+    def sup(self):
+        if self._sup is None:
+            self._sup = psi4.driver.dft.build_superfunctional(self.func, False)[0]
+            self._sup.set_deriv(2)
+            self._sup.allocate()
+        return self._sup
+
+    @property
+    def aux(self):
+        if self._aux is None:
+            self._aux = psi4.core.BasisSet.build(self.mol, "DF_BASIS_SCF", "", "JKFIT", self.basis)
+        return self._aux
+
+    @property
+    def Vpot(self):
+        return self.get_Vpot()
+
+    @property
+    def coarse_Vpot(self):
+        return self.get_Vpot(coarse=True)
+
+    def get_Vpot(self, restricted=False, coarse=False):
+        """
+        Initialized VBase, "RV" for a restricted and "UV" for an unrestricted
+        density, on the target grid or the coarse grid of the COARSE_GRID
+        schedule. Every kind is built once.
+        """
+        kind = ("RV" if restricted else "UV", coarse)
+        if kind not in self._Vpot:
+            options = {}
+            if coarse:
+                options = {
+                    "DFT_SPHERICAL_POINTS" : psi4.core.get_local_option("PSIXAS", "COARSE_SPHERICAL_POINTS"),
+                    "DFT_RADIAL_POINTS"    : psi4.core.get_local_option("PSIXAS", "COARSE_RADIAL_POINTS"),
+                    "DFT_BASIS_TOLERANCE"  : psi4.core.get_local_option("PSIXAS", "COARSE_BASIS_TOLERANCE")}
+            self._Vpot[kind] = self._build_Vpot(kind[0], options)
+        return self._Vpot[kind]
+
+    def _build_Vpot(self, kind, options):
+        """
+        VBase built with the grid options temporarily replaced by options
+        """
+        old = {}
+        for name, value in options.items():
+            old[name] = (psi4.core.get_global_option(name), psi4.core.has_global_option_changed(name))
+            psi4.core.set_global_option(name, value)
+        try:
+            Vpot = psi4.core.VBase.build(self.wfn.basisset(), self.sup, kind)
+            Vpot.initialize()
+        finally:
+            for name, (value, changed) in old.items():
+                psi4.core.set_global_option(name, value)
+                if not changed:
+                    psi4.core.revoke_global_option_changed(name)
+        return Vpot
+
+    @property
+    def dipole(self):
+        if self._dipole is None:
+            # stacked 3 x nbf x nbf, x/y/z are views
+            self._dipole = self._fetch("dipole", lambda: np.array([np.asarray(x) for x in self.mints.ao_dipole()]))
+        return self._dipole
+
+    @property
+    def plan(self):
+        """
+        Memory plan (JK algorithm and memory, DIIS spilling), see ksmemory
+        """
+        if self._plan is None:
+            requested = requestedSCFType()
+            naux = self.aux.nbf() if requested in DF_TYPES + [None] else 0
+            self._plan = planJK(self.nbf, naux, self.nalpha, self.nbeta,
+                                psi4.core.get_local_option("PSIXAS", "MIX"),
+                                self._function_pairs() if naux > 0 else None)
+            printPlan(self._plan)
+        return self._plan
+
+    def get_jk(self):
+        """
+        Returns the initialized JK object with its C_left list cleared,
+        ready for the caller to add its own occupied orbitals.
+        """
+        if self._jk is None:
+            plan = self.plan
+            if plan["jk_type"] in DF_TYPES:
+                aux = self.aux
+            else:
+                aux = psi4.core.BasisSet.zero_ao_basis_set()
+            self._jk = psi4.core.JK.build(self.wfn.basisset(), aux, plan["jk_type"])
+            self._jk.set_memory(plan["jk_memory"])
+            self._jk.initialize()
+        self._jk.C_clear()
+        return self._jk
+
+    def _function_pairs(self):
+        """
+        Number of significant basis function pairs (Schwarz screening)
+        """
+        try:
+            sieve = psi4.core.ERISieve(self.wfn.basisset(), psi4.core.get_global_option("INTS_TOLERANCE"))
+            return len(sieve.function_pairs())
+        except (AttributeError, RuntimeError):
+            return self.nbf*(self.nbf + 1)//2
+
+    def build_uhf(self):
+        """
+        UHF object, only used to write molden files
+        """
+        uhf = psi4.core.UHF(self.wfn, self.sup)
+        psi4.core.reopen_outfile()
+        return uhf
+
+    def build_diis(self, mix="DAMP"):
+        """
+        DIIS object for the MIX scheme (plain DIIS for DAMP), spilled to
+        scratch if nbf reaches DIIS_SPILL_NBF or it does not fit in memory
+        """
+        spill_dir = None
+        spill = psi4.core.get_local_option("PSIXAS", "DIIS_SPILL_NBF")
+        if ((spill > 0) and (self.nbf >= spill)) or self.plan["spill_diis"]:
+            spill_dir = psi4.core.IOManager.shared_object().get_default_path()
+
+        if mix in ["ADIIS", "EDIIS"]:
+            return ADIIS_helper(mode=mix, spill_dir=spill_dir)
+        return DIIS_helper(spill_dir=spill_dir)
@@ -6,12 +6,26 @@ Created on Sun Aug 19 18:30:31 2018
 
 Module to perform excited state calculations
 """
-from .kshelper import diag_H,DIIS_helper,Timer
+from .kshelper import diag_H,diagRoots,diisError,density,fockMatrix,maxAbs,Profiler,IncrementalJK,OrbitalTracker,SCFWorkspace,SpinPool,printIterStats,atomicSavez
+from .kscontext import KSContext
+from .ksmemory import printMemoryUsage
+from .ksorbs import OrbitalStore,writeOrbitals
+from .ksexport import exportCFOUR
+from .kslinalg import freezeShift
 import numpy as np
 import os
 import psi4
 import time
 
+def occupiedOrbitals(C,occ,Cocc):
+    """
+    Occupation weighted orbitals C sqrt(occ) into Cocc; if C holds only the
+    lowest orbitals the others are empty
+    """
+    k = C.shape[1]
+    np.multiply(C,np.sqrt(occ[:k]),out=Cocc[:,:k])
+    Cocc[:,k:] = 0.0
+
 def DFTExcitedState(mol,func,orbitals,**kwargs):
     """
     Perform unrestrictred Kohn-Sham excited state calculation
@@ -26,15 +40,25 @@ def DFTExcitedState(mol,func,orbitals,**kwargs):
     """
     STEP 1: Read in ground state orbitals or restart from previous
     """
-    prefix = psi4.core.get_local_option("PSIXAS","PREFIX")
-
-    if (os.path.isfile(prefix+"_exorbs.npz") and False):
-        psi4.core.print_out("Restarting Calculation\n")
-        Ca = np.load(prefix+"_exorbs.npz")["Ca"]
-        Cb = np.load(prefix+"_exorbs.npz")["Cb"]
+    prefix   = kwargs.get("PREFIX",psi4.core.get_local_option("PSIXAS","PREFIX"))
+    gsprefix = kwargs.get("GSPREFIX",prefix)
+
+    chkfile  = prefix+"_exchk.npz"
+    chk_iter = psi4.core.get_local_option("PSIXAS","CHKPT_ITER")
+    chk_time = psi4.core.get_local_option("PSIXAS","CHKPT_TIME")
+
+    restart = psi4.core.get_local_option("PSIXAS","RESTART") and os.path.isfile(chkfile)
+    if restart:
+        psi4.core.print_out("Restarting Calculation from {}\n".format(chkfile))
+        chk = dict(np.load(chkfile))
+        Ca = chk["Ca"]
+        Cb = chk["Cb"]
+        if len(chk["orbs"]) != len(orbitals):
+            raise Exception("Checkpoint does not match the ORBS input.")
     else:
-        Ca = np.load(prefix+"_gsorbs.npz")["Ca"]
-        Cb = np.load(prefix+"_gsorbs.npz")["Cb"]
+        gsorbs = OrbitalStore(gsprefix+"_gsorbs.npz")
+        Ca = gsorbs.C("a")
+        Cb = gsorbs.C("b")
 
     
 
@@ -43,52 +67,48 @@ def DFTExcitedState(mol,func,orbitals,**kwargs):
     Grep the coefficients for later overlap
     """
 
-    for i in orbitals:
-        if i["spin"]=="b":
+    for n,i in enumerate(orbitals):
+        if i["spin"] not in ["a","b"]:
+            raise Exception("Orbital has non a/b spin!")
+        if restart:
+            # reference orbitals and current index of the interrupted run
+            i["C"]   = chk["Cref"][:,n]
+            i["orb"] = int(chk["orbs"][n])
+        elif i["spin"]=="b":
             i["C"] = Cb[:,i["orb"]]
         elif i["spin"]=="a":
             i["C"] = Ca[:,i["orb"]]
-        else:
-            raise Exception("Orbital has non a/b spin!")
-
 
-    wfn   = psi4.core.Wavefunction.build(mol,psi4.core.get_global_option('BASIS'))
-    aux     = psi4.core.BasisSet.build(mol, "DF_BASIS_SCF", "", "JKFIT", psi4.core.get_global_option('BASIS'))
 
-    #psi4.core.be_quiet()
-    mints = psi4.core.MintsHelper(wfn.basisset())
+    ctx = kwargs.get("CTX")
+    if ctx is None:
+        ctx = KSContext(mol,func)
 
-    S = np.asarray(mints.ao_overlap())
-    T = np.asarray(mints.ao_kinetic())
-    V = np.asarray(mints.ao_potential())
-    H = np.zeros((mints.nbf(),mints.nbf()))
+    wfn   = ctx.wfn
+    mints = ctx.mints
 
-    H = T+V
+    S = ctx.S
+    H = ctx.H
+    A = ctx.A
 
-    A = mints.ao_overlap()
-    A.power(-0.5,1.e-16)
-    A = np.asarray(A)
-
-    Enuc = mol.nuclear_repulsion_energy()
+    Enuc = ctx.Enuc
     Eold = 0.0
     SCF_E = 100.0
-    nbf    = wfn.nso()
-    nalpha = wfn.nalpha()
-    nbeta  = wfn.nbeta()
+    nbf    = ctx.nbf
+    nalpha = ctx.nalpha
+    nbeta  = ctx.nbeta
 
     Va = psi4.core.Matrix(nbf,nbf)
     Vb = psi4.core.Matrix(nbf,nbf)
 
-    sup = psi4.driver.dft.build_superfunctional(func, False)[0]
-    sup.set_deriv(2)
-    sup.allocate()
-
-    Vpot = psi4.core.VBase.build(wfn.basisset(), sup, "UV")
-    Vpot.initialize()
+    # coarse grid for the first iterations, see COARSE_GRID
+    coarse   = psi4.core.get_local_option("PSIXAS","COARSE_GRID")
+    coarse_E = psi4.core.get_local_option("PSIXAS","COARSE_E_SWITCH")
+    coarse_D = psi4.core.get_local_option("PSIXAS","COARSE_D_SWITCH")
+    Vpot = ctx.coarse_Vpot if coarse else ctx.Vpot
 
     #This object is needed to write out a molden file later
-    uhf   = psi4.core.UHF(wfn,sup)
-    psi4.core.reopen_outfile()
+    uhf   = ctx.build_uhf()
     """
     Form initial denisty
     """
@@ -101,65 +121,71 @@ def DFTExcitedState(mol,func,orbitals,**kwargs):
     Cocca = psi4.core.Matrix(nbf, nbf)
     Coccb = psi4.core.Matrix(nbf, nbf)
 
-    Cocca.np[:]  = Ca
-    Coccb.np[:]  = Cb
-
-    for i in orbitals:
-        if i["spin"]=="b":
-            """
-            Check if this is still the largest overlap
-            """
-            ovl = np.abs(np.einsum('m,nj,mn->j',i["C"],Coccb,S))
-            if i["orb"] != np.argmax(ovl):
-                print ("index changed from {:d} to {:d}".format(i["orb"],np.argmax(ovl)))
-                i["orb"] = np.argmax(ovl)
-
-            """
-            Set occupation and overlap
-            """
-            i["ovl"] = np.max(ovl)
-            occb[i["orb"]] = i["occ"]
-
-
-        elif i["spin"]=="a":
-            """
-            Check if this is still the largest overlap
-            """
-            ovl = np.abs(np.einsum('m,nj,mn->j',i["C"],Cocca,S))
-            if i["orb"] != np.argmax(ovl):
-                print ("index changed from {:d} to {:d}".format(i["orb"],np.argmax(ovl)))
-                i["orb"] = np.argmax(ovl)
-            """
-            Set occupation and overlap
-            """
-            i["ovl"] = np.max(ovl)
-            occa[i["orb"]] = i["occ"]
-
-    for i in range(nbf):
-        Cocca.np[:,i] *= np.sqrt(occa[i])
-        Coccb.np[:,i] *= np.sqrt(occb[i])
-
-
-    Da     = Cocca.np @ Cocca.np.T
-    Db     = Coccb.np @ Coccb.np.T
-
-    jk = psi4.core.JK.build(wfn.basisset(),aux,"MEM_DF")
-    glob_mem = psi4.core.get_memory()/8
-    jk.set_memory(int(glob_mem*0.6))
-    jk.initialize()
-    jk.C_left_add(Cocca)
-    jk.C_left_add(Coccb)
+    tracker = OrbitalTracker(orbitals,S)
+    for spin,C,occ in (("a",Ca,occa),("b",Cb,occb)):
+        # Check if this is still the largest overlap
+        for o,n in tracker.update(C,occ,spin,follow_all=not restart):
+            print ("index changed from {:d} to {:d}".format(o,n))
+
+    # preallocated arrays of the SCF iterations
+    ws = SCFWorkspace(nbf)
+    Fa,Fb           = ws.F
+    Da,Db           = ws.D
+    diisa_e,diisb_e = ws.err
+    # orbitals of a checkpoint may be the lowest ones only, see DIAG_NVIRT
+    ws.C[0][:,:Ca.shape[1]] = Ca
+    ws.C[1][:,:Cb.shape[1]] = Cb
+    Ca = ws.C[0][:,:Ca.shape[1]]
+    Cb = ws.C[1][:,:Cb.shape[1]]
+
+    occupiedOrbitals(Ca,occa,Cocca.np)
+    occupiedOrbitals(Cb,occb,Coccb.np)
+
+    density(Cocca.np,Da)
+    density(Coccb.np,Db)
+
+    jk = ctx.get_jk()
+    incjk = IncrementalJK(jk,
+                          psi4.core.get_local_option("PSIXAS","INCFOCK"),
+                          psi4.core.get_local_option("PSIXAS","INCFOCK_FULL_EVERY"),
+                          psi4.core.get_local_option("PSIXAS","INCFOCK_THRESH"),
+                          ctx.plan["jk_type"] == "DIRECT")
 
     Da_m = psi4.core.Matrix(nbf,nbf)
     Db_m = psi4.core.Matrix(nbf,nbf)
 
-    diisa = DIIS_helper()
-    diisb = DIIS_helper()
+    mix   = psi4.core.get_local_option("PSIXAS","MIX")
+    diisa = ctx.build_diis()
+    diisb = ctx.build_diis()
+    diis  = ctx.build_diis(mix)
+    if restart:
+        diisa.set_state("diisa_",chk)
+        diisb.set_state("diisb_",chk)
+        diis.set_state("diis_",chk)
+
+    # warm start from the ground state: the first J/K build is incremental
+    # from the ground state J/K (of the saved orbitals) if the density change
+    # is low rank, damping starts from the ground state Fock.
+    # The DIIS subspace starts empty, ground state error vectors would pull
+    # the extrapolation back to the ground state.
+    haveOld = False
+    if psi4.core.get_local_option("PSIXAS","WARMSTART") and not restart:
+        gsstate = ctx.gs_state
+        if gsstate is None:
+            gsstate = OrbitalStore(gsprefix+"_gsorbs.npz")
+        if "Fa" in gsstate:
+            psi4.core.print_out("Warm start from the ground state Fock matrices\n")
+            incjk.set_state("jk_",gsstate)
+            np.copyto(ws.Fold[0],gsstate["Fa"])
+            np.copyto(ws.Fold[1],gsstate["Fb"])
+            haveOld = True
+        else:
+            psi4.core.print_out("No ground state Fock matrices in {}_gsorbs.npz, cold start\n".format(gsprefix))
 
     gamma    =  psi4.core.get_local_option("PSIXAS","DAMP")
     diis_eps =  psi4.core.get_local_option("PSIXAS","DIIS_EPS")
     vshift   =  psi4.core.get_local_option("PSIXAS","VSHIFT")
-    psi4.core.print_out("\nStarting SCF:\n"+13*"="+"\n\n{:>10} {:4.2f}\n{:>10} {:4.2f}\n{:>10} {:4.2f}\n\n".format("DAMP:",gamma,"DIIS_EPS:",diis_eps,"VSHIFT:",vshift))
+    psi4.core.print_out("\nStarting SCF:\n"+13*"="+"\n\n{:>10} {:4.2f}\n{:>10} {:4.2f}\n{:>10} {:4.2f}\n{:>10} {}\n\n".format("DAMP:",gamma,"DIIS_EPS:",diis_eps,"VSHIFT:",vshift,"MIX:",mix))
  
     psi4.core.print_out("\nInitial orbital occupation pattern:\n\n")
     psi4.core.print_out("Index|Spin|Occ|Ovl|Freeze\n"+25*"-")
@@ -176,119 +202,97 @@ def DFTExcitedState(mol,func,orbitals,**kwargs):
     psi4.core.print_out("="*80+"\n")
 
    
-    myTimer = Timer()
-    MIXMODE = "DAMP"
-    for SCF_ITER in range(1, maxiter + 1):
-        myTimer.addStart("SCF")
-
-        myTimer.addStart("JK")
-        jk.compute()
-        myTimer.addEnd("JK")
+    prof = Profiler()
+    # alpha and beta steps run concurrently with PARALLEL_SPINS
+    spins = SpinPool(psi4.core.get_local_option("PSIXAS","PARALLEL_SPINS"))
+    MIXMODE  = "DAMP"
+    mixcount = {}
+    dEold    = 0.0
+    start    = 1
+    if restart:
+        start   = int(chk["iter"]) + 1
+        Eold    = float(chk["Eold"])
+        dEold   = float(chk["dEold"])
+        vshift  = float(chk["vshift"])
+        MIXMODE = str(chk["mixmode"])
+        if not bool(chk.get("coarse",False)):
+            coarse = False
+            Vpot   = ctx.Vpot
+        np.copyto(Fa,chk["Fa"])
+        np.copyto(Fb,chk["Fb"])
+        del chk
+    # VSHIFT acts on the empty orbitals above the aufbau occupation
+    aufbaua  = np.arange(nbf) >= nalpha
+    aufbaub  = np.arange(nbf) >= nbeta
+    # occupied and tracked orbitals plus DIAG_NVIRT during the SCF, all at
+    # convergence
+    nroots   = diagRoots(max([nalpha]+[i["orb"]+1 for i in orbitals]),nbf)
+    chk_last = time.time()
+    for SCF_ITER in range(start, maxiter + 1):
+        prof.start("SCF")
+
+        prof.start("JK")
+        seeded = incjk.seeded
+        (Ja,Jb),(Ka,Kb) = incjk.compute([Cocca,Coccb],[Da,Db])
+        prof.stop("JK")
+        if seeded:
+            if incjk.last_full:
+                psi4.core.print_out("First J/K build: full, the density change from the ground state is not low rank\n")
+            else:
+                psi4.core.print_out("First J/K build: incremental from the ground state, rank {:d}/{:d} (alpha/beta)\n".format(*incjk.last_rank))
         
 
 
-        myTimer.addStart("buildFock")
+        prof.start("compV")
         Da_m.np[:] = Da
         Db_m.np[:] = Db
         Vpot.set_D([Da_m,Db_m])
-        myTimer.addStart("compV")
         Vpot.compute_V([Va,Vb])
-        myTimer.addEnd("compV")
-
-        Ja = np.asarray(jk.J()[0])
-        Jb = np.asarray(jk.J()[1])
-        Ka = np.asarray(jk.K()[0])
-        Kb = np.asarray(jk.K()[1])
+        prof.stop("compV")
 
+        prof.start("Fock")
         if SCF_ITER>1 :
-            FaOld = np.copy(Fa)
-            FbOld = np.copy(Fb)
+            np.copyto(ws.Fold,ws.F)
+            haveOld = True
 
-        Fa = H + (Ja + Jb) - Vpot.functional().x_alpha()*Ka + Va
-        Fb = H + (Ja + Jb) - Vpot.functional().x_alpha()*Kb + Vb
+        alpha = Vpot.functional().x_alpha()
+        J     = np.add(Ja,Jb,out=ws.J)
+        fockMatrix(H,J,Ka,alpha,Va.np,Fa)
+        fockMatrix(H,J,Kb,alpha,Vb.np,Fb)
 
-        myTimer.addEnd("buildFock")
+        prof.stop("Fock")
         """
         Fock matrix constructed: freeze orbitals if needed
         """
-        myTimer.addStart("Freeze")        
-        FMOa = Ca.T @ Fa @ Ca
-        FMOb = Cb.T @ Fb @ Cb
-
-
-        CaInv = np.linalg.inv(Ca)
-        CbInv = np.linalg.inv(Cb)
-
-        for i in orbitals:
-            if i['frz'] == True:
-                if i["spin"]=="b":
-                    idx = i["orb"]
-                    FMOb[idx,:idx]     = 0.0
-                    FMOb[idx,(idx+1):] = 0.0
-                    FMOb[:idx,idx]     = 0.0
-                    FMOb[(idx+1):,idx] = 0.0
-                elif i["spin"]=="a":
-                    FMOa[idx,:idx]     = 0.0
-                    FMOa[idx,(idx+1):] = 0.0
-                    FMOa[:idx,idx]     = 0.0
-                    FMOa[(idx+1):,idx] = 0.0
+        prof.start("Freeze")        
+        frza = [i["orb"] for i in orbitals if i["frz"] and i["spin"]=="a"]
+        frzb = [i["orb"] for i in orbitals if i["frz"] and i["spin"]=="b"]
         """
         VSHIFT 
         """        
-        idxs = [c for c,x in enumerate(occa) if (x ==0.0) and (c>=nalpha)]
-        FMOa[idxs,idxs] += vshift
-        idxs = [c for c,x in enumerate(occb) if (x ==0.0) and (c>=nbeta)]
-        FMOb[idxs,idxs] += vshift
+        virta = (occa == 0.0) & aufbaua
+        virtb = (occb == 0.0) & aufbaub
 
-        Fa = CaInv.T @ FMOa @ CaInv
-        Fb = CbInv.T @ FMOb @ CbInv
+        spins.map(freezeShift,ws.F,[Ca,Cb],[S,S],[frza,frzb],[virta[:Ca.shape[1]],virtb[:Cb.shape[1]]],[vshift,vshift],ws.F,ws.work[:,0])
 
-        myTimer.addEnd("Freeze")
+        prof.stop("Freeze")
         """
         END FREEZE
         """
 
-        """
-        DIIS/MIXING
-        """
-        myTimer.addStart("MIX")      
-        
-        diisa_e = Fa.dot(Da).dot(S) - S.dot(Da).dot(Fa)
-        diisa_e = (A.T).dot(diisa_e).dot(A)
-        diisa.add(Fa, diisa_e)
-
-        diisb_e = Fb.dot(Db).dot(S) - S.dot(Db).dot(Fb)
-        diisb_e = (A.T).dot(diisb_e).dot(A)
-        diisb.add(Fb, diisb_e)
-
-        if (MIXMODE == "DIIS") and (SCF_ITER>1):
-            # Extrapolate alpha & beta Fock matrices separately
-            Fa = diisa.extrapolate()
-            Fb = diisb.extrapolate()
-        elif (MIXMODE == "DAMP") and (SCF_ITER>1):
-            # Use Damping to obtain the new Fock matrices
-            Fa = (1-gamma) * np.copy(Fa) + (gamma) * FaOld
-            Fb = (1-gamma) * np.copy(Fb) + (gamma) * FbOld
-        
-        myTimer.addEnd("MIX")    
-        """
-        END DIIS/MIXING
-        """
-
         """
         CALC energy
         """
-        myTimer.addStart("calcE")
+        prof.start("Energy")
 
-        one_electron_E  = np.sum(Da * H)
-        one_electron_E += np.sum(Db * H)
-        coulomb_E       = np.sum(Da * (Ja+Jb))
-        coulomb_E      += np.sum(Db * (Ja+Jb))
+        one_electron_E  = np.vdot(Da,H)
+        one_electron_E += np.vdot(Db,H)
+        coulomb_E       = np.vdot(Da,J)
+        coulomb_E      += np.vdot(Db,J)
 
-        alpha       = Vpot.functional().x_alpha()
         exchange_E  = 0.0
-        exchange_E -= alpha * np.sum(Da * Ka)
-        exchange_E -= alpha * np.sum(Db * Kb)
+        exchange_E -= alpha * np.vdot(Da,Ka)
+        exchange_E -= alpha * np.vdot(Db,Kb)
 
         XC_E = Vpot.quadrature_values()["FUNCTIONAL"]
 
@@ -298,22 +302,51 @@ def DFTExcitedState(mol,func,orbitals,**kwargs):
         SCF_E += 0.5 * coulomb_E
         SCF_E += 0.5 * exchange_E
         SCF_E += XC_E
-        myTimer.addEnd("calcE")
+        prof.stop("Energy")
+
+        """
+        DIIS/MIXING
+        """
+        prof.start("DIIS")      
         
-        # Diagonalize Fock matrix
-        myTimer.addStart("Diag")
-        Ca,epsa = diag_H(Fa, A)
-        Cb,epsb = diag_H(Fb, A)
-        myTimer.addEnd("Diag")
+        spins.map(diisError,ws.F,ws.D,[S,S],[A,A],ws.err,ws.work)
+        Derr    = max(maxAbs(diisa_e),maxAbs(diisb_e))
+
+        if mix == "DAMP":
+            diisa.add(Fa, diisa_e)
+            diisb.add(Fb, diisb_e)
+
+            if (MIXMODE == "DIIS") and (SCF_ITER>1):
+                # Extrapolate alpha & beta Fock matrices separately
+                diisa.extrapolate(Fa)
+                diisb.extrapolate(Fb)
+            elif (MIXMODE == "DAMP") and haveOld:
+                # Use Damping to obtain the new Fock matrices
+                ws.F    *= 1-gamma
+                ws.Fold *= gamma
+                ws.F    += ws.Fold
+        else:
+            # energy based DIIS, alpha & beta extrapolated together
+            diis.add(ws.F, ws.err, ws.D, SCF_E)
+            diis.extrapolate(ws.F)
+            MIXMODE = diis.last_mode
 
+        mixcount[MIXMODE] = mixcount.get(MIXMODE,0) + 1
+        prof.stop("DIIS")    
         """
-        New orbitals obtained set occupation numbers
+        END DIIS/MIXING
         """
-        myTimer.addStart("SetOcc")
 
-        Cocca.np[:]  = Ca
-        Coccb.np[:]  = Cb
+        
+        # Diagonalize Fock matrix
+        prof.start("Diag")
+        (Ca,epsa),(Cb,epsb) = spins.map(diag_H,ws.F,[A,A],ws.C,ws.work,[nroots,nroots])
+        prof.stop("Diag")
 
+        """
+        New orbitals obtained set occupation numbers
+        """
+        prof.start("Occupation")
 
         occa[:] = 0.0
         occb[:] = 0.0
@@ -321,85 +354,105 @@ def DFTExcitedState(mol,func,orbitals,**kwargs):
         occa[:nalpha] = 1.0  #standard aufbau principle occupation
         occb[:nbeta]  = 1.0
 
+        # Overlap with the reference orbitals, switch the index if the
+        # user wants to follow the highest overlap
+        tracker.update(Ca,occa,"a")
+        tracker.update(Cb,occb,"b")
 
-        for i in orbitals:
-            if i["spin"]=="b":
-                """
-                Overlap
-                """
-                #calculate the Overlapp with all other orbitals
-                ovl = np.abs(np.einsum('m,nj,mn->j',i["C"],Coccb,S))
-                #User wants to switch the index if higher overlap is found
-                if i["DoOvl"] ==True :
-                    if i["orb"] != np.argmax(ovl):
-                        i["orb"] = np.argmax(ovl)
-                    i["ovl"] = np.max(ovl)
-                else:
-                    #just calculate the overlap to assess the character
-                    i["ovl"] = ovl[i["orb"]]
-                #Modify the occupation vector
-                occb[i["orb"]] = i["occ"]
-
-            elif i["spin"]=="a":
-                """
-                Check if this is still the largest overlap
-                """
-                ovl = np.abs(np.einsum('m,nj,mn->j',i["C"],Cocca,S))
-                if i["DoOvl"] ==True :
-                    if i["orb"] != np.argmax(ovl):
-                        i["orb"] = np.argmax(ovl) # set index to the highest overlap
-                    i["ovl"] = np.max(ovl)
-                else:
-                    i["ovl"] = ovl[i["orb"]]
-                #Modify the occupation vector
-                occa[i["orb"]] = i["occ"]
-                
-
-        for i in range(nbf):
-            Cocca.np[:,i] *= np.sqrt(occa[i])
-            Coccb.np[:,i] *= np.sqrt(occb[i])
+        occupiedOrbitals(Ca,occa,Cocca.np)
+        occupiedOrbitals(Cb,occb,Coccb.np)
         
-        Da     = Cocca.np @ Cocca.np.T
-        Db     = Coccb.np @ Coccb.np.T
+        spins.map(density,[Cocca.np,Coccb.np],ws.D)
 
-        myTimer.addEnd("SetOcc")
+        prof.stop("Occupation")
         
-        myTimer.addEnd("SCF")
+        prof.stop("SCF")
         psi4.core.print_out(("{:3d} {:14.8f} {:14.8f} {:4.1f} {:4.1f} | "+"{:4.2f} "*len(orbitals)+"| {:^4} {:5.2f} \n").format(
             SCF_ITER,
             SCF_E,
             (SCF_E - Eold),
-            np.sum(Da*S),
-            np.sum(Db*S),
+            np.vdot(Da,S),
+            np.vdot(Db,S),
             *[x["ovl"] for x in orbitals],
             MIXMODE,
-            myTimer.getTime("SCF") ))
+            prof.last("SCF") ))
         psi4.core.flush_outfile()
-        myTimer.printAlltoFile("timers.ksex")
         
-        if (abs(SCF_E - Eold) < diis_eps):
-            MIXMODE = "DIIS"
-        else:
-            MIXMODE = "DAMP"  
+        if (mix == "DAMP"):
+            if (abs(SCF_E - Eold) < diis_eps):
+                MIXMODE = "DIIS"
+            else:
+                MIXMODE = "DAMP"  
         
         
-        if (abs(SCF_E - Eold) < E_conv):
+        # rebuild J/K from the full density if the error grows
+        if (SCF_ITER > 2) and (abs(SCF_E - Eold) > abs(dEold)):
+            incjk.force_full()
+        dEold = SCF_E - Eold
+
+        if coarse and ((abs(SCF_E - Eold) < coarse_E) or (Derr < coarse_D)):
+            # continue on the target grid, the coarse grid Fock matrices
+            # must not enter the extrapolation
+            psi4.core.print_out("Switching to the target DFT grid\n")
+            coarse = False
+            Vpot   = ctx.Vpot
+            diisa  = ctx.build_diis()
+            diisb  = ctx.build_diis()
+            diis   = ctx.build_diis(mix)
+        elif (abs(SCF_E - Eold) < E_conv):
             if (vshift != 0.0):
                 psi4.core.print_out("Converged but Vshift was on... removing Vshift..\n")
                 vshift = 0.0
+            elif not incjk.last_full:
+                # only accept an energy from a fully rebuilt J/K
+                incjk.force_full()
             else:
                 break
 
 
         Eold = SCF_E   
 
-
+        # checkpoint every CHKPT_ITER iterations / CHKPT_TIME seconds
+        # and, if checkpoints are on, before giving up
+        if ((chk_iter > 0) and (SCF_ITER % chk_iter == 0)) or \
+           ((chk_time > 0) and (time.time() - chk_last > chk_time)) or \
+           ((chk_iter > 0 or chk_time > 0) and (SCF_ITER == maxiter)):
+            prof.start("Checkpoint")
+            chk = {"Ca" : Ca, "Cb" : Cb, "occa" : occa, "occb" : occb, "Fa" : Fa, "Fb" : Fb,
+                   "orbs"    : np.array([i["orb"] for i in orbitals]),
+                   "ovl"     : np.array([i["ovl"] for i in orbitals]),
+                   "Cref"    : np.array([i["C"] for i in orbitals]).T,
+                   "iter"    : np.array(SCF_ITER),
+                   "Eold"    : np.array(Eold),
+                   "dEold"   : np.array(dEold),
+                   "vshift"  : np.array(vshift),
+                   "mixmode" : np.array(MIXMODE),
+                   "coarse"  : np.array(coarse)}
+            chk.update(diisa.get_state("diisa_"))
+            chk.update(diisb.get_state("diisb_"))
+            chk.update(diis.get_state("diis_"))
+            atomicSavez(chkfile,**chk)
+            del chk
+            prof.stop("Checkpoint")
+            chk_last = time.time()
 
         if SCF_ITER == maxiter:
             psi4.core.clean()
             raise Exception("Maximum number of SCF cycles exceeded.")
 
+    if nroots is not None:
+        # full spectrum of the final Fock matrices for the saved orbitals
+        (Ca,epsa),(Cb,epsb) = spins.map(diag_H,ws.F,[A,A],ws.C,ws.work)
+    spins.shutdown()
     psi4.core.print_out("\n\n{:>20} {:12.8f} [Ha] \n".format("FINAL EX SCF ENERGY:",SCF_E))
+    if os.path.isfile(chkfile):
+        os.remove(chkfile)
+    printIterStats(mix,SCF_ITER,mixcount)
+    prof.report("EX SCF")
+    printMemoryUsage("EX",ctx.plan)
+    if psi4.core.get_local_option("PSIXAS","PROFILE"):
+        prof.toJSON(prefix+"_ex_profile.json")
+    psi4.core.set_variable('EX ITERATIONS', SCF_ITER)
 
     
     gsE = psi4.core.scalar_variable('GS ENERGY')
@@ -447,48 +500,8 @@ def DFTExcitedState(mol,func,orbitals,**kwargs):
     mw = psi4.core.MoldenWriter(uhf)
     mw.write(prefix+'_ex.molden',uhf.Ca(),uhf.Cb(),uhf.epsilon_a(),uhf.epsilon_b(),OCCA,OCCB,True)
     psi4.core.print_out("\n\n Moldenfile written\n")
-    np.savez(prefix+'_exorbs',Ca=Ca,Cb=Cb,occa=occa,occb=occb,epsa=epsa,epsb=epsb,orbitals=orbitals)
+    writeOrbitals(prefix+'_exorbs.npz',Ca,Cb,occa,occb,epsa,epsb,orbitals,energy=SCF_E)
 
     psi4.core.set_variable('CURRENT ENERGY', SCF_E)
     
-    bas = wfn.basisset()
-
-    with open("GENBAS", "w") as genbas:
-        genbas.write(bas.genbas())
-        
-    maxl = bas.max_am()
-    map = []
-    lmap = [[0],
-            [1,2,0],
-            [0,4,1,3,2],
-            [1,2,0,5,4,6,3],
-            [0,4,1,7,6,3,8,5,2],
-            [1,2,3,5,8,10,7,6,0,9,4],
-            [11,4,9,7,10,3,12,5,8,0,6,2,1]]
-
-    for i in range(mol.natom()):
-        for l in range(maxl+1):
-            for li in range(2*l+1):
-                for j in range(bas.nshell()):
-                    s = bas.shell(j)
-                    if bas.shell_to_center(j) == i and s.am == l:
-                        k = bas.shell_to_basis_function(j)
-                        if l > 6:
-                            m = l - li//2
-                            k += 2*m + li%2
-                        else:
-                            k += lmap[l][li]
-                        map.append(k)
-                        
-    assert(len(map) == mints.nbf())
-    assert(sorted(map) == list(range(mints.nbf())))
-        
-    with open("OLDMOS", "w") as oldmos:
-        for C in (Ca, Cb):
-            for j0 in range(0,mints.nbf(),4):
-                for i in range(mints.nbf()):
-                    for j in range(j0,min(mints.nbf(),j0+4)):
-                        oldmos.write("%30.20e" % (C[map[i]][j]));
-                    oldmos.write('\n');
-                
-    open("JFSGUESS", "w").close()
+    exportCFOUR(wfn.basisset(),Ca,Cb)
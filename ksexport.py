@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Export of orbitals in CFOUR format (GENBAS, OLDMOS, JFSGUESS)
+
+The permutation from psi4 to CFOUR basis function order is built with
+array operations and OLDMOS is written in blocks. With CFOUR_EXPORT
+BACKGROUND the files are written by a separate thread while the
+calculation continues; waitExports() joins all pending writers. Every
+export writes the same files, so a new export first waits for the pending
+one.
+"""
+import os
+import threading
+import numpy as np
+import psi4
+
+
+# psi4 -> CFOUR order of the pure functions within a shell, l <= 6
+LMAP = [[0],
+        [1,2,0],
+        [0,4,1,3,2],
+        [1,2,0,5,4,6,3],
+        [0,4,1,7,6,3,8,5,2],
+        [1,2,3,5,8,10,7,6,0,9,4],
+        [11,4,9,7,10,3,12,5,8,0,6,2,1]]
+
+_pending = []
+
+
+def cfourMap(bas):
+    """
+    Index of the psi4 basis function of every CFOUR basis function: per
+    atom, per l, per component, all shells of that atom and l.
+    """
+    nshell = bas.nshell()
+    center = np.array([bas.shell_to_center(j) for j in range(nshell)])
+    am     = np.array([bas.shell(j).am for j in range(nshell)])
+    start  = np.array([bas.shell_to_basis_function(j) for j in range(nshell)])
+
+    # one entry per (shell, component)
+    ncomp = 2*am + 1
+    shell = np.repeat(np.arange(nshell), ncomp)
+    li    = np.arange(ncomp.sum()) - np.repeat(np.cumsum(ncomp) - ncomp, ncomp)
+    l     = am[shell]
+
+    lmap = np.zeros((len(LMAP), 2*len(LMAP) - 1), dtype=int)
+    for n, x in enumerate(LMAP):
+        lmap[n, :len(x)] = x
+    offset = np.where(l > 6, 2*(l - li//2) + li % 2, lmap[np.minimum(l, 6), np.minimum(li, lmap.shape[1] - 1)])
+
+    order = np.lexsort((shell, li, l, center[shell]))
+    return (start[shell] + offset)[order]
+
+
+def writeOLDMOS(filename, Cs, map):
+    """
+    Writes the coefficient matrices Cs with rows permuted by map, four
+    columns per block.
+    """
+    with open(filename, "w") as oldmos:
+        for C in Cs:
+            Cm = np.asarray(C)[map]
+            nrow, ncol = Cm.shape
+            for j0 in range(0, ncol, 4):
+                block = Cm[:, j0:j0 + 4]
+                fmt = ("%30.20e"*block.shape[1] + "\n")*nrow
+                oldmos.write(fmt % tuple(block.ravel()))
+
+
+def _export(path, genbas, map, Ca, Cb):
+    with open(os.path.join(path, "GENBAS"), "w") as f:
+        f.write(genbas)
+    writeOLDMOS(os.path.join(path, "OLDMOS"), (Ca, Cb), map)
+    open(os.path.join(path, "JFSGUESS"), "w").close()
+
+
+def exportCFOUR(bas, Ca, Cb):
+    """
+    Writes GENBAS, OLDMOS and JFSGUESS according to the CFOUR_EXPORT
+    option (NONE, SYNC or BACKGROUND).
+    """
+    mode = psi4.core.get_local_option("PSIXAS", "CFOUR_EXPORT")
+    if mode == "NONE":
+        return
+
+    map = cfourMap(bas)
+    assert(len(map) == bas.nbf())
+    assert(np.array_equal(np.sort(map), np.arange(bas.nbf())))
+
+    # the files of a previous export must not be written concurrently
+    waitExports()
+
+    # into the current directory of the caller, even if it changes
+    args = (os.getcwd(), bas.genbas(), map, np.array(Ca), np.array(Cb))
+    if mode == "BACKGROUND":
+        t = threading.Thread(target=_export, args=args)
+        t.start()
+        _pending.append(t)
+    else:
+        _export(*args)
+
+
+def waitExports():
+    """
+    Waits for all background exports to finish.
+    """
+    while _pending:
+        _pending.pop().join()
@@ -6,7 +6,12 @@ Created on Sun Aug 19 01:57:59 2018
 """
 import psi4
 import numpy as np
-from .kshelper import diag_H,DIIS_helper,Timer
+from .kshelper import diag_H,diagRoots,diisError,density,fockMatrix,maxAbs,absDiff,Profiler,IncrementalJK,SCFWorkspace,SpinPool,printIterStats
+from .kscontext import KSContext
+from .ksmemory import printMemoryUsage
+from .ksorbs import OrbitalStore,writeOrbitals
+from .ksexport import exportCFOUR
+from .ksguess import initialGuess
 import os.path
 import time
 
@@ -23,87 +28,89 @@ def DFTGroundState(mol,func,**kwargs):
 
     prefix = kwargs["PREFIX"]
 
-    basis = psi4.core.get_global_option('BASIS')
-    wfn   = psi4.core.Wavefunction.build(mol,basis)
-    aux   = psi4.core.BasisSet.build(mol, "DF_BASIS_SCF", "", "JKFIT", basis)
+    ctx = kwargs.get("CTX")
+    if ctx is None:
+        ctx = KSContext(mol,func)
 
-    sup = psi4.driver.dft.build_superfunctional(func, False)[0]
-    #psi4.core.be_quiet()
-    mints = psi4.core.MintsHelper(wfn.basisset())
-    
-    sup.set_deriv(2)
-    sup.allocate()
-
-    uhf   = psi4.core.UHF(wfn,sup)
-    psi4.core.reopen_outfile()
-    
-    S = np.asarray(mints.ao_overlap())
-    T = np.asarray(mints.ao_kinetic())
-    V = np.asarray(mints.ao_potential())
-    H = np.zeros((mints.nbf(),mints.nbf()))
+    wfn   = ctx.wfn
+    mints = ctx.mints
+    sup   = ctx.sup
+    uhf   = ctx.build_uhf()
 
-    H = T+V
+    S = ctx.S
+    H = ctx.H
+    A = ctx.A
 
-    if wfn.basisset().has_ECP():
-        ECP = mints.ao_ecp()
-        H += ECP
-
-    A = mints.ao_overlap()
-    A.power(-0.5,1.e-16)
-    A = np.asarray(A)
-
-    Enuc = mol.nuclear_repulsion_energy()
+    Enuc = ctx.Enuc
     Eold = 0.0
 
-    nbf    = wfn.nso()
-    nalpha = wfn.nalpha()
-    nbeta  = wfn.nbeta()
+    nbf    = ctx.nbf
+    nalpha = ctx.nalpha
+    nbeta  = ctx.nbeta
 
     Va = psi4.core.Matrix(nbf,nbf)
     Vb = psi4.core.Matrix(nbf,nbf)
 
-    Vpot = psi4.core.VBase.build(wfn.basisset(), sup, "UV")
-    Vpot.initialize()
+    # closed shell: one spin channel, beta is alpha
+    restricted = kwargs.get("RESTRICTED",psi4.core.get_local_option("PSIXAS","GS_RESTRICTED"))
+    if restricted == "AUTO":
+        restricted = (nalpha == nbeta) and (mol.multiplicity() == 1)
+    else:
+        restricted = (restricted == "YES")
+        if restricted and (nalpha != nbeta):
+            raise Exception("GS_RESTRICTED YES needs a closed-shell molecule.")
+
+    # coarse grid for the first iterations, see COARSE_GRID
+    coarse   = psi4.core.get_local_option("PSIXAS","COARSE_GRID")
+    coarse_E = psi4.core.get_local_option("PSIXAS","COARSE_E_SWITCH")
+    coarse_D = psi4.core.get_local_option("PSIXAS","COARSE_D_SWITCH")
+    Vpot = ctx.get_Vpot(restricted,coarse)
 
     gamma    =  float(psi4.core.get_local_option("PSIXAS","DAMP"))
     diis_eps =  float(psi4.core.get_local_option("PSIXAS","DIIS_EPS"))
+    mix      =  psi4.core.get_local_option("PSIXAS","MIX")
     """
     Read or Core Guess
     """    
     Cocca       = psi4.core.Matrix(nbf, nalpha)
     Coccb       = psi4.core.Matrix(nbf, nbeta)
+
+    # preallocated arrays of the SCF iterations, one spin if restricted
+    ws = SCFWorkspace(nbf, 1 if restricted else 2)
+    Da,Db = ws.D[0],ws.D[-1]
     if (os.path.isfile(prefix+"_gsorbs.npz")):
         psi4.core.print_out("Restarting Calculation")
-        Ca = np.load(prefix+"_gsorbs.npz")["Ca"]
-        Cb = np.load(prefix+"_gsorbs.npz")["Cb"]
+        gsorbs = OrbitalStore(prefix+"_gsorbs.npz")
+        Ca = gsorbs.C("a")
+        Cb = gsorbs.C("b")
     else:
         Ca = np.zeros((0,0))
         Cb = np.zeros((0,0))
         
     if Ca.shape == (nbf,nbf):
         Cocca.np[:]  = Ca[:, :nalpha]
-        Da     = Ca[:, :nalpha] @ Ca[:, :nalpha].T
         Coccb.np[:]  = Cb[:, :nbeta]
-        Db     = Cb[:, :nbeta] @ Cb[:, :nbeta].T
     else:
-        Ca,epsa     = diag_H(H,A)       
-        Cocca.np[:] = Ca[:, :nalpha]
-        Da          = Ca[:, :nalpha] @ Ca[:, :nalpha].T
-
-        Cb,epsb     = diag_H(H,A)        
-        Coccb.np[:] = Cb[:, :nbeta]
-        Db          = Cb[:, :nbeta] @ Cb[:, :nbeta].T
+        guess = kwargs.get("GUESS",psi4.core.get_local_option("PSIXAS","GUESS"))
+        psi4.core.print_out("Initial guess: {}\n".format(guess))
+        Cocca.np[:],Coccb.np[:] = initialGuess(ctx,mol,func,guess,prefix,restricted,coarse)
+
+    if restricted:
+        Coccb.np[:] = Cocca.np
+    density(Cocca.np,Da)
+    if not restricted:
+        density(Coccb.np,Db)
     """
     end read
     """
 
-    # Initialize the JK object
-    jk = psi4.core.JK.build(wfn.basisset(),aux,"MEM_DF")
-    glob_mem = psi4.core.get_memory()/8
-    jk.set_memory(int(glob_mem*0.6))
-    jk.initialize()
-    jk.C_left_add(Cocca)
-    jk.C_left_add(Coccb)
+    # Get the shared JK object
+    jk = ctx.get_jk()
+    incjk = IncrementalJK(jk,
+                          psi4.core.get_local_option("PSIXAS","INCFOCK"),
+                          psi4.core.get_local_option("PSIXAS","INCFOCK_FULL_EVERY"),
+                          psi4.core.get_local_option("PSIXAS","INCFOCK_THRESH"),
+                          ctx.plan["jk_type"] == "DIRECT")
 
     Da_m = psi4.core.Matrix(nbf,nbf)
     Db_m = psi4.core.Matrix(nbf,nbf)
@@ -112,83 +119,81 @@ def DFTGroundState(mol,func,**kwargs):
     psi4.core.print_out(sup.description())
     psi4.core.print_out(sup.citation())
     
-    psi4.core.print_out("\nStarting SCF:\n"+13*"="+"\n\n{:>10} {:8.4f}\n{:>10} {:8.4f} \n{:>10} {:4d}\n".format("DAMP:",gamma,"DIIS_EPS:",diis_eps,"MAXITER:",maxiter))
+    psi4.core.print_out("\nStarting SCF:\n"+13*"="+"\n\n{:>10} {:8.4f}\n{:>10} {:8.4f} \n{:>10} {:4d}\n{:>10} {}\n".format("DAMP:",gamma,"DIIS_EPS:",diis_eps,"MAXITER:",maxiter,"MIX:",mix))
+    psi4.core.print_out("{:>10} {}\n".format("SPIN:","RESTRICTED" if restricted else "UNRESTRICTED"))
     
     
     psi4.core.print_out("\n\n{:^4} {:^14} {:^14} {:^14} {:^4} {:^6} \n".format("# IT", "Escf", "dEscf","Derror","MIX","Time"))
     psi4.core.print_out("="*80+"\n")
 
-    diisa = DIIS_helper()
-    diisb = DIIS_helper()
+    diisa = ctx.build_diis()
+    diisb = ctx.build_diis()
+    diis  = ctx.build_diis(mix)
 
-    myTimer = Timer()
+    prof = Profiler()
 
-    MIXMODE = "DAMP"
+    # alpha and beta steps run concurrently with PARALLEL_SPINS
+    spins = SpinPool(psi4.core.get_local_option("PSIXAS","PARALLEL_SPINS") and not restricted)
+
+    # occupied orbitals plus DIAG_NVIRT during the SCF, all at convergence
+    nroots          = diagRoots(nalpha,nbf)
+    Fa,Fb           = ws.F[0],ws.F[-1]
+    DaOld,DbOld     = ws.Dold[0],ws.Dold[-1]
+    diisa_e,diisb_e = ws.err[0],ws.err[-1]
+
+    MIXMODE  = "DAMP"
+    mixcount = {}
+    dEold    = 0.0
     for SCF_ITER in range(1, maxiter + 1):
-        myTimer.addStart("SCF")     
-        jk.compute()
+        prof.start("SCF")
+        prof.start("JK")
+        if restricted:
+            (Ja,),(Ka,) = incjk.compute([Cocca],[Da])
+            Jb,Kb = Ja,Ka
+        else:
+            (Ja,Jb),(Ka,Kb) = incjk.compute([Cocca,Coccb],[Da,Db])
+        prof.stop("JK")
         
         """
         Build Fock
         """
+        prof.start("compV")
         Da_m.np[:] = Da
-        Db_m.np[:] = Db
-        Vpot.set_D([Da_m,Db_m])
-        Vpot.compute_V([Va,Vb])
-
-        Ja = np.asarray(jk.J()[0])
-        Jb = np.asarray(jk.J()[1])
-        Ka = np.asarray(jk.K()[0])
-        Kb = np.asarray(jk.K()[1])
+        if restricted:
+            Vpot.set_D([Da_m])
+            Vpot.compute_V([Va])
+        else:
+            Db_m.np[:] = Db
+            Vpot.set_D([Da_m,Db_m])
+            Vpot.compute_V([Va,Vb])
+        prof.stop("compV")
 
+        prof.start("Fock")
         if SCF_ITER>1 :
-            FaOld = np.copy(Fa)
-            FbOld = np.copy(Fb)
-
-        Fa = (H + (Ja + Jb) - Vpot.functional().x_alpha()*Ka + Va)
-        Fb = (H + (Ja + Jb) - Vpot.functional().x_alpha()*Kb + Vb)
+            np.copyto(ws.Fold,ws.F)
+
+        alpha = Vpot.functional().x_alpha()
+        J     = np.add(Ja,Jb,out=ws.J)
+        fockMatrix(H,J,Ka,alpha,Va.np,Fa)
+        if not restricted:
+            fockMatrix(H,J,Kb,alpha,Vb.np,Fb)
+        prof.stop("Fock")
         """
         END BUILD FOCK
         """
 
-        """
-        DIIS/MIXING
-        """
-        diisa_e = Fa.dot(Da).dot(S) - S.dot(Da).dot(Fa)
-        diisa_e = (A.T).dot(diisa_e).dot(A)
-        diisa.add(Fa, diisa_e)
-
-        diisb_e = Fb.dot(Db).dot(S) - S.dot(Db).dot(Fb)
-        diisb_e = (A.T).dot(diisb_e).dot(A)
-        diisb.add(Fb, diisb_e)
-
-        if (MIXMODE == "DIIS") and (SCF_ITER>1):
-            # Extrapolate alpha & beta Fock matrices separately
-            Fa = diisa.extrapolate()
-            Fb = diisb.extrapolate()
-        elif (MIXMODE == "DAMP") and (SCF_ITER>1):
-            #...but use damping to obtain the new Fock matrices
-            Fa = (1-gamma) * np.copy(Fa) + (gamma) * FaOld
-            Fb = (1-gamma) * np.copy(Fb) + (gamma) * FbOld
-
-        """
-        END DIIS/MIXING
-        """
-
-        
-
         """
         CALC E
         """
-        one_electron_E  = np.sum(Da * H)
-        one_electron_E += np.sum(Da * H)
-        coulomb_E       = np.sum(Da * (Ja+Jb))
-        coulomb_E      += np.sum(Db * (Ja+Jb))
+        prof.start("Energy")
+        one_electron_E  = np.vdot(Da,H)
+        one_electron_E += np.vdot(Db,H)
+        coulomb_E       = np.vdot(Da,J)
+        coulomb_E      += np.vdot(Db,J)
 
-        alpha       = Vpot.functional().x_alpha()
         exchange_E  = 0.0;
-        exchange_E -= alpha * np.sum(Da * Ka)
-        exchange_E -= alpha * np.sum(Db * Kb)
+        exchange_E -= alpha * np.vdot(Da,Ka)
+        exchange_E -= alpha * np.vdot(Db,Kb)
 
         XC_E = Vpot.quadrature_values()["FUNCTIONAL"];
 
@@ -199,25 +204,72 @@ def DFTGroundState(mol,func,**kwargs):
         SCF_E += 0.5 * coulomb_E
         SCF_E += 0.5 * exchange_E
         SCF_E += XC_E
+        prof.stop("Energy")
         """
         END CALCE
         """
-        
 
         """
-        DIAG F + BUILD D
+        DIIS/MIXING
         """
-        DaOld = np.copy(Da)
-        DbOld = np.copy(Db)
+        prof.start("DIIS")
+        spins.map(diisError,ws.F,ws.D,[S,S],[A,A],ws.err,ws.work)
+        Derr    = max(maxAbs(diisa_e),maxAbs(diisb_e))
+
+        if mix == "DAMP":
+            diisa.add(Fa, diisa_e)
+            if not restricted:
+                diisb.add(Fb, diisb_e)
+
+            if (MIXMODE == "DIIS") and (SCF_ITER>1):
+                # Extrapolate alpha & beta Fock matrices separately
+                diisa.extrapolate(Fa)
+                if not restricted:
+                    diisb.extrapolate(Fb)
+            elif (MIXMODE == "DAMP") and (SCF_ITER>1):
+                #...but use damping to obtain the new Fock matrices
+                ws.F    *= 1-gamma
+                ws.Fold *= gamma
+                ws.F    += ws.Fold
+        elif restricted:
+            # the total density 2 Da keeps the energy model of the unrestricted case
+            np.multiply(ws.D,2.0,out=ws.work[0,:1])
+            diis.add(ws.F, ws.err, ws.work[0,:1], SCF_E)
+            diis.extrapolate(ws.F)
+            MIXMODE = diis.last_mode
+        else:
+            # energy based DIIS, alpha & beta extrapolated together
+            diis.add(ws.F, ws.err, ws.D, SCF_E)
+            diis.extrapolate(ws.F)
+            MIXMODE = diis.last_mode
 
-        Ca,epsa = diag_H(Fa, A)
-        Cocca.np[:]  = Ca[:, :nalpha]
-        Da      = Cocca.np @ Cocca.np.T
+        mixcount[MIXMODE] = mixcount.get(MIXMODE,0) + 1
+        prof.stop("DIIS")
+        """
+        END DIIS/MIXING
+        """
 
+        """
+        DIAG F + BUILD D
+        """
+        np.copyto(ws.Dold,ws.D)
 
-        Cb,epsb = diag_H(Fb, A)
-        Coccb.np[:]  = Cb[:, :nbeta]
-        Db      = Coccb.np @ Coccb.np.T
+        prof.start("Diag")
+        if restricted:
+            Ca,epsa = diag_H(Fa,A,ws.C[0],ws.work[0],nroots)
+            Cb,epsb = Ca,epsa
+        else:
+            (Ca,epsa),(Cb,epsb) = spins.map(diag_H,ws.F,[A,A],ws.C,ws.work,[nroots,nroots])
+        prof.stop("Diag")
+
+        prof.start("Occupation")
+        Cocca.np[:]  = Ca[:, :nalpha]
+        if restricted:
+            density(Cocca.np,Da)
+        else:
+            Coccb.np[:]  = Cb[:, :nbeta]
+            spins.map(density,[Cocca.np,Coccb.np],ws.D)
+        prof.stop("Occupation")
         """
         END DIAG F + BUILD D
         """
@@ -226,22 +278,40 @@ def DFTGroundState(mol,func,**kwargs):
         OUTPUT
         """
 
-        myTimer.addEnd("SCF")
+        prof.stop("SCF")
         psi4.core.print_out(" {:3d} {:14.8f} {:14.8f} {:14.8f} {:^4} {:6.2f}\n".format(SCF_ITER,
              SCF_E,
              (SCF_E - Eold),
-             (np.mean(np.abs(DaOld-Da)) + np.sum(np.abs(DbOld-Db))),
+             (np.mean(absDiff(DaOld,Da,ws.work[0,0])) + np.sum(absDiff(DbOld,Db,ws.work[0,0]))),
              MIXMODE,
-             myTimer.getTime("SCF")))
+             prof.last("SCF")))
                   
         psi4.core.flush_outfile()
-        if (abs(SCF_E - Eold) < diis_eps):
-            MIXMODE = "DIIS"
-        else:
-            MIXMODE = "DAMP"        
+        if (mix == "DAMP"):
+            if (abs(SCF_E - Eold) < diis_eps):
+                MIXMODE = "DIIS"
+            else:
+                MIXMODE = "DAMP"        
         
-        if (abs(SCF_E - Eold) < E_conv):
-            break
+        # rebuild J/K from the full density if the error grows
+        if (SCF_ITER > 2) and (abs(SCF_E - Eold) > abs(dEold)):
+            incjk.force_full()
+        dEold = SCF_E - Eold
+
+        if coarse and ((abs(SCF_E - Eold) < coarse_E) or (Derr < coarse_D)):
+            # continue on the target grid, the coarse grid Fock matrices
+            # must not enter the extrapolation
+            psi4.core.print_out("Switching to the target DFT grid\n")
+            coarse = False
+            Vpot   = ctx.get_Vpot(restricted)
+            diisa  = ctx.build_diis()
+            diisb  = ctx.build_diis()
+            diis   = ctx.build_diis(mix)
+        elif (abs(SCF_E - Eold) < E_conv):
+            # only accept an energy from a fully rebuilt J/K
+            if incjk.last_full:
+                break
+            incjk.force_full()
 
         Eold = SCF_E
 
@@ -249,7 +319,21 @@ def DFTGroundState(mol,func,**kwargs):
             clean()
             raise Exception("Maximum number of SCF cycles exceeded.")
 
+    if nroots is not None:
+        # full spectrum of the final Fock matrices for the saved orbitals
+        if restricted:
+            Ca,epsa = diag_H(Fa,A,ws.C[0],ws.work[0])
+            Cb,epsb = Ca,epsa
+        else:
+            (Ca,epsa),(Cb,epsb) = spins.map(diag_H,ws.F,[A,A],ws.C,ws.work)
+    spins.shutdown()
     psi4.core.print_out("\n\nFINAL GS SCF ENERGY: {:12.8f} [Ha] \n\n".format(SCF_E))
+    printIterStats(mix,SCF_ITER,mixcount)
+    prof.report("GS SCF")
+    printMemoryUsage("GS",ctx.plan)
+    if psi4.core.get_local_option("PSIXAS","PROFILE"):
+        prof.toJSON(prefix+"_gs_profile.json")
+    psi4.core.set_variable('GS ITERATIONS', SCF_ITER)
 
     mw = psi4.core.MoldenWriter(wfn)
     occa = np.zeros(nbf,dtype=np.float)
@@ -279,52 +363,33 @@ def DFTGroundState(mol,func,**kwargs):
     mw.write(prefix+'_gs.molden',uhf.Ca(),uhf.Cb(),uhf.epsilon_a(),uhf.epsilon_b(),OCCA,OCCB,True)
     psi4.core.print_out("Moldenfile written\n")
 
-    np.savez(prefix+'_gsorbs',Ca=Ca,Cb=Cb,occa=occa,occb=occb,epsa=epsa,epsb=epsb)
+    # hand the converged Fock and J/K to the excited state, in memory and
+    # through the orbital file. The last J/K build was from the density
+    # before the final diagonalization; the excited state starts from the
+    # saved orbitals, so its J/K are rebuilt for their density.
+    gsstate = {}
+    if psi4.core.get_local_option("PSIXAS","WARMSTART"):
+        incjk.force_full()
+        if restricted:
+            incjk.compute([Cocca],[Da])
+        else:
+            incjk.compute([Cocca,Coccb],[Da,Db])
+        gsstate = {"Fa" : Fa, "Fb" : Fb}
+        gsstate.update(incjk.get_state("jk_"))
+        if restricted:
+            # the excited state is unrestricted, beta J/K are the alpha ones
+            for key in ["jk_D","jk_J","jk_K"]:
+                if key in gsstate:
+                    gsstate[key] = np.concatenate([gsstate[key],gsstate[key]])
+        ctx.gs_state = gsstate
+
+    writeOrbitals(prefix+'_gsorbs.npz',Ca,Cb,occa,occb,epsa,epsb,energy=SCF_E,**gsstate)
     psi4.core.print_out("Canonical Orbitals written\n\n")
 
     psi4.core.set_variable('CURRENT ENERGY', SCF_E)
     psi4.core.set_variable('GS ENERGY', SCF_E)
     
-    bas = wfn.basisset()
-
-    with open("GENBAS", "w") as genbas:
-        genbas.write(bas.genbas())
-        
-    maxl = bas.max_am()
-    map = []
-    lmap = [[0],
-            [1,2,0],
-            [0,4,1,3,2],
-            [1,2,0,5,4,6,3],
-            [0,4,1,7,6,3,8,5,2],
-            [1,2,3,5,8,10,7,6,0,9,4],
-            [11,4,9,7,10,3,12,5,8,0,6,2,1]]
-
-    for i in range(mol.natom()):
-        for l in range(maxl+1):
-            for li in range(2*l+1):
-                for j in range(bas.nshell()):
-                    s = bas.shell(j)
-                    if bas.shell_to_center(j) == i and s.am == l:
-                        k = bas.shell_to_basis_function(j)
-                        if l > 6:
-                            m = l - li//2
-                            k += 2*m + li%2
-                        else:
-                            k += lmap[l][li]
-                        map.append(k)
-                        
-    assert(len(map) == mints.nbf())
-    assert(sorted(map) == list(range(mints.nbf())))
-        
-    with open("OLDMOS", "w") as oldmos:
-        for C in (Ca, Cb):
-            for j0 in range(0,mints.nbf(),4):
-                for i in range(mints.nbf()):
-                    for j in range(j0,min(mints.nbf(),j0+4)):
-                        oldmos.write("%30.20e" % (C[map[i]][j]));
-                    oldmos.write('\n');
-                
-    open("JFSGUESS", "w").close()
+    if kwargs.get("EXPORT",True):
+        exportCFOUR(wfn.basisset(),Ca,Cb)
                     
     return uhf
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Initial guesses of the ground state SCF (GUESS option)
+
+CORE  : orbitals of the core Hamiltonian
+SAD   : orbitals of the Fock matrix built from a superposition of
+        atomic densities (one J/K build)
+BASIS : ground state converged in GUESS_BASIS, occupied orbitals projected
+        onto the target basis
+"""
+import numpy as np
+import psi4
+from .kshelper import diag_H
+
+
+GUESSES = ["CORE", "SAD", "BASIS"]
+
+
+def coreGuess(ctx):
+    """
+    Occupied alpha and beta orbitals of the core Hamiltonian
+    """
+    C, eps = diag_H(ctx.H, ctx.A)
+    return C[:, :ctx.nalpha], C[:, :ctx.nbeta]
+
+
+def sadDensity(ctx):
+    """
+    Alpha and beta superposition of atomic densities from psi4
+    """
+    mol   = ctx.mol
+    basis = ctx.wfn.basisset()
+    atoms = psi4.core.BasisSet.build(mol, "ORBITAL", ctx.basis, puream=basis.has_puream(),
+                                     return_atomlist=True)
+    sad = psi4.core.SADGuess.build_SAD(basis, atoms)
+    if psi4.core.get_global_option("SAD_SCF_TYPE") == "DF":
+        fit = psi4.core.BasisSet.build(mol, "DF_BASIS_SAD", psi4.core.get_option("SCF", "DF_BASIS_SAD"),
+                                       puream=True, return_atomlist=True)
+        sad.set_atomic_fit_bases(fit)
+    sad.compute_guess()
+    return np.asarray(sad.Da()), np.asarray(sad.Db())
+
+
+def sadGuess(ctx, restricted=False, coarse=False):
+    """
+    Occupied orbitals of the Kohn-Sham Fock matrix of the SAD densities.
+    The XC potential is computed with the VBase of the ground state SCF
+    (restricted, coarse grid), so no extra one is built.
+    """
+    Da, Db = sadDensity(ctx)
+
+    # the SAD densities are positive semidefinite, J/K from D = L L^T
+    jk = ctx.get_jk()
+    for D in [Da, Db]:
+        e, U = np.linalg.eigh(D)
+        keep = e > 1.0E-10
+        jk.C_left_add(psi4.core.Matrix.from_array(U[:, keep]*np.sqrt(e[keep])))
+    jk.compute()
+    Ja, Jb = np.asarray(jk.J()[0]), np.asarray(jk.J()[1])
+    Ka, Kb = np.asarray(jk.K()[0]), np.asarray(jk.K()[1])
+    jk.C_clear()
+
+    Va = psi4.core.Matrix(ctx.nbf, ctx.nbf)
+    Vb = psi4.core.Matrix(ctx.nbf, ctx.nbf)
+    Vpot = ctx.get_Vpot(restricted, coarse)
+    if restricted:
+        Vpot.set_D([psi4.core.Matrix.from_array(Da)])
+        Vpot.compute_V([Va])
+        Vb = Va
+    else:
+        Vpot.set_D([psi4.core.Matrix.from_array(Da), psi4.core.Matrix.from_array(Db)])
+        Vpot.compute_V([Va, Vb])
+
+    alpha = Vpot.functional().x_alpha()
+    Ca, epsa = diag_H(ctx.H + Ja + Jb - alpha*Ka + np.asarray(Va), ctx.A)
+    Cb, epsb = diag_H(ctx.H + Ja + Jb - alpha*Kb + np.asarray(Vb), ctx.A)
+    return Ca[:, :ctx.nalpha], Cb[:, :ctx.nbeta]
+
+
+def projectOrbitals(ctx, basis, C):
+    """
+    Projects orbitals C of the basis set basis onto the basis of ctx and
+    orthonormalizes them: C' = S^-1 S_12 C (C^T S_21 S^-1 S_12 C)^-1/2
+    """
+    S12 = np.asarray(ctx.mints.ao_overlap(ctx.wfn.basisset(), basis))
+    Cp  = ctx.A @ (ctx.A @ (S12 @ C))
+    e, U = np.linalg.eigh(Cp.T @ ctx.S @ Cp)
+    return Cp @ (U*e**-0.5) @ U.T
+
+
+def basisGuess(ctx, mol, func, prefix):
+    """
+    Ground state in GUESS_BASIS, projected onto the basis of ctx
+    """
+    from .kscontext import KSContext
+    from .ksgs import DFTGroundState
+
+    small = psi4.core.get_local_option("PSIXAS", "GUESS_BASIS")
+    psi4.core.print_out("\nInitial guess from a ground state in {}\n".format(small))
+
+    sctx = KSContext(mol, func, basis=small)
+    uhf  = DFTGroundState(mol, func, PREFIX=prefix+"_guess", CTX=sctx, GUESS="SAD", EXPORT=False)
+    Ca = np.asarray(uhf.Ca())[:, :sctx.nalpha]
+    Cb = np.asarray(uhf.Cb())[:, :sctx.nbeta]
+    basis = sctx.wfn.basisset()
+    return projectOrbitals(ctx, basis, Ca), projectOrbitals(ctx, basis, Cb)
+
+
+def initialGuess(ctx, mol, func, guess, prefix, restricted=False, coarse=False):
+    """
+    Occupied alpha and beta orbitals of the initial guess guess
+    """
+    if guess == "CORE":
+        return coreGuess(ctx)
+    if guess == "SAD":
+        return sadGuess(ctx, restricted, coarse)
+    if guess == "BASIS":
+        return basisGuess(ctx, mol, func, prefix)
+    raise Exception("Unknown GUESS {}, use one of {}".format(guess, GUESSES))
@@ -5,141 +5,517 @@ Created on Sun Aug 19 18:30:11 2018
 @author: luke
 """
 
+import concurrent.futures
+import contextlib
+import json
 import numpy as np
+import os
+import psi4
+import tempfile
 import time
+from .kslinalg import diag_H,diisError,density,fockMatrix,maxAbs,absDiff,DIIS_helper,OrbitalTracker
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+try:
+    from scipy.optimize import minimize
+except ImportError:
+    minimize = None
 
-def diag_H(H, A):
-    Hp = A.dot(H).dot(A)
-    e, C2 = np.linalg.eigh(Hp)
-    C = A.dot(C2)
-    return (C,e)
+def diagRoots(nocc, nbf):
+    """
+    Number of orbitals diag_H computes in an SCF iteration: the lowest
+    nocc plus DIAG_NVIRT, None (all) if DIAG_NVIRT is negative
+    """
+    nvirt = psi4.core.get_local_option("PSIXAS","DIAG_NVIRT")
+    if (nvirt < 0) or (nocc + nvirt >= nbf):
+        return None
+    return nocc + nvirt
+
+def atomicSavez(filename, **arrays):
+    """
+    np.savez to a temporary file that is then renamed to filename, so a
+    crash during the write never leaves a corrupt file behind.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def printIterStats(mix, niter, counts):
+    """
+    Print the number of SCF iterations and how many were spent in each
+    mixing mode, to compare the MIX schemes.
+    """
+    psi4.core.print_out("{:>20} {:d} (MIX: {})\n".format("SCF ITERATIONS:", niter, mix))
+    for mode in sorted(counts):
+        psi4.core.print_out("{:>20} {:d}\n".format(mode+":", counts[mode]))
+    psi4.core.print_out("\n")
+
+def peakRSS():
+    """
+    Peak resident set size of the process in MB (0 if unavailable)
+    """
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+class Profiler(object):
+    """
+    Low overhead profiler with nested regions.
+
+    Regions are opened with start(name) and closed with stop(name), or
+    used as context manager with region(name). A region started inside
+    another one is recorded under the path "outer/inner". For every path
+    the number of calls, the total/min/max/last time and the peak RSS
+    seen when it was closed are kept.
+    """
 
-class Timer(object):
     def __init__(self):
-        self.entries = {}
-    def addStart(self,entry):
-        if (entry in self.entries):
-            self.entries[entry]["Start"] = time.time()
-        else:
-            self.entries[entry] = { }
-            self.entries[entry]["Start"] = time.time()
+        self.stats = {}
+        self.stack = []
 
-    def addEnd(self,entry):
-        if (entry in self.entries):
-            self.entries[entry]["End"] = time.time()
-        else:
-            self.entries[entry] = { }
-            self.entries[entry]["End"] = time.time()
-    
-    def getTime(self,entry):
-        return (self.entries[entry]["End"] - self.entries[entry]["Start"])
+    def start(self, name):
+        path = name if not self.stack else self.stack[-1][0] + "/" + name
+        if path not in self.stats:
+            self.stats[path] = {"calls": 0, "total": 0.0, "min": float("inf"), "max": 0.0, "last": 0.0, "rss": 0.0}
+        self.stack.append((path, time.perf_counter()))
+
+    def stop(self, name):
+        if not self.stack:
+            raise Exception("Profiler: closing region {} but no region is open.".format(name))
+        path, t0 = self.stack[-1]
+        if path.rsplit("/", 1)[-1] != name:
+            raise Exception("Profiler: closing region {} but {} is open.".format(name, path))
+        self.stack.pop()
+        dt = time.perf_counter() - t0
+        s = self.stats[path]
+        s["calls"] += 1
+        s["total"] += dt
+        s["last"]   = dt
+        s["min"]    = min(s["min"], dt)
+        s["max"]    = max(s["max"], dt)
+        s["rss"]    = max(s["rss"], peakRSS())
 
-    def printAlltoFile(self,filename):
-        S = "Timings:\n"
-        for x in self.entries:
-            S += "{:^10} | {:5.2f}s \n".format(x,self.getTime(x))
-        S+="\n"
-        open(filename,"a").write(S)
+    @contextlib.contextmanager
+    def region(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
 
+    def last(self, path):
+        """
+        Duration of the last call of a region
+        """
+        return self.stats[path]["last"]
+
+    def report(self, title):
+        """
+        Prints all regions, indented by nesting level
+        """
+        psi4.core.print_out("\n{} timings:\n\n".format(title))
+        psi4.core.print_out("{:<24} {:>6} {:>10} {:>9} {:>9} {:>9} {:>9}\n".format(
+            "Region", "Calls", "Total[s]", "Mean[s]", "Min[s]", "Max[s]", "RSS[MB]"))
+        psi4.core.print_out(82*"-"+"\n")
+        for path in self.stats:
+            s = self.stats[path]
+            if s["calls"] == 0:
+                continue
+            depth = path.count("/")
+            name  = "  "*depth + path.rsplit("/", 1)[-1]
+            psi4.core.print_out("{:<24} {:6d} {:10.3f} {:9.4f} {:9.4f} {:9.4f} {:9.1f}\n".format(
+                name, s["calls"], s["total"], s["total"]/s["calls"], s["min"], s["max"], s["rss"]))
+        psi4.core.print_out("\n")
 
-class DIIS_helper(object):
+    def toJSON(self, filename):
+        """
+        Writes the statistics of all regions to a JSON file
+        """
+        stats = {path: dict(s, mean=s["total"]/s["calls"]) for path, s in self.stats.items() if s["calls"] > 0}
+        with open(filename, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+
+class SCFWorkspace(object):
+    """
+    Preallocated arrays of one SCF loop. An iteration works in place (out=)
+    on them instead of allocating nbf x nbf temporaries; the old Fock and
+    density matrices are copied into Fold/Dold instead of new arrays.
+
+    All arrays have a leading spin axis (F[0] alpha, F[-1] beta, the same
+    array if nspin is 1), so the stacked F, err and D go to the joint DIIS
+    as they are. work holds two scratch matrices per spin, the spins can be
+    processed concurrently.
+    """
+
+    def __init__(self, nbf, nspin=2):
+        shape = (nspin, nbf, nbf)
+        self.nspin = nspin
+        self.F    = np.zeros(shape)
+        self.Fold = np.zeros(shape)
+        self.D    = np.zeros(shape)
+        self.Dold = np.zeros(shape)
+        self.C    = np.zeros(shape)
+        self.err  = np.zeros(shape)
+        self.J    = np.zeros((nbf, nbf))
+        self.work = np.zeros((nspin, 2, nbf, nbf))
+
+class SpinPool(object):
+    """
+    Runs the independent alpha and beta parts of an SCF step (commutators,
+    diagonalization, densities) in two threads, each with half of the BLAS
+    threads; numpy releases the GIL in BLAS/LAPACK calls. The BLAS threads
+    are only split if threadpoolctl is installed.
     """
-    A helper class to compute DIIS extrapolations.
+
+    def __init__(self, parallel=False, threads=None):
+        self.pool = None
+        self.blas = None
+        if parallel:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+            if threads is None:
+                threads = psi4.core.get_num_threads()
+            self.blas = max(1, threads//2)
+
+    def _limits(self):
+        if threadpool_limits is None:
+            return contextlib.suppress()
+        return threadpool_limits(limits=self.blas, user_api="blas")
+
+    def map(self, func, *args):
+        """
+        [func(a0, b0, ...), func(a1, b1, ...)] for args = (a, b, ...), one
+        entry per spin
+        """
+        if self.pool is None or len(args[0]) < 2:
+            return [func(*x) for x in zip(*args)]
+        with self._limits():
+            futures = [self.pool.submit(func, *x) for x in zip(*args)]
+            return [f.result() for f in futures]
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+class ADIIS_helper(DIIS_helper):
+    """
+    Energy based DIIS (ADIIS or EDIIS) blended into CDIIS.
     Notes
     -----
-    Equations taken from [Sherrill:1998], [Pulay:1980:393], & [Pulay:1969:197]
-    Algorithms adapted from [Sherrill:1998] & [Pulay:1980:393]
+    ADIIS from [Hu:2010:054109], EDIIS from [Kudin:2002:8255], blending
+    adapted from [Garza:2012:054110]. Alpha and beta are extrapolated
+    together, states, errors and densities are stacked over spin.
+
+    Far from convergence (max. error > start) only the energy based
+    coefficients are used, below finish only the CDIIS ones, in between a
+    linear combination weighted by the error.
     """
 
-    def __init__(self, max_vec=6):
+    def __init__(self, max_vec=6, mode="ADIIS", spill_dir=None, start=1.0E-1, finish=1.0E-4):
         """
-        Intializes the DIIS class.
         Parameters
         ----------
         max_vec : int (default, 6)
-            The maximum number of vectors to use. The oldest vector will be deleted.
+            The maximum number of vectors to use.
+        mode : str (default, "ADIIS")
+            Energy model, "ADIIS" or "EDIIS".
+        spill_dir : str (default, None)
+            Directory for memory-mapped subspace files.
+        start, finish : float
+            Error thresholds of the EDIIS/ADIIS -> CDIIS transition.
         """
-        self.error = []
-        self.vector = []
-        self.max_vec = max_vec
+        if mode not in ["ADIIS", "EDIIS"]:
+            raise Exception("Unknown energy DIIS mode: {}".format(mode))
+        if minimize is None:
+            raise Exception("MIX {} needs scipy (scipy.optimize).".format(mode))
+        DIIS_helper.__init__(self, max_vec, spill_dir)
+        self.mode    = mode
+        self.start   = start
+        self.finish  = finish
+        self.density = None
+        self.energy  = np.zeros(max_vec)
+        # P[i,j] = D_i . F_j
+        self.P       = np.zeros((max_vec, max_vec))
+        self.newest  = 0
+        self.last_mode = "DIIS"
 
-    def add(self, state, error):
+    def add(self, state, error, density, energy):
+        """
+        Adds state (Fock), error, density and energy of one iteration.
+        """
+        density = np.asarray(density)
+        if self.density is None:
+            self.density = self._allocate((self.max_vec,) + density.shape, density.dtype)
+
+        slot = self.head
+        DIIS_helper.add(self, state, error)
+        self.density[slot] = density
+        self.energy[slot]  = energy
+        self.newest = slot
+
+        n = self.nvec
+        D = self.density[:n].reshape(n, -1)
+        F = self.vector[:n].reshape(n, -1)
+        self.P[slot, :n] = F.dot(D[slot])
+        self.P[:n, slot] = D.dot(F[slot])
+
+    def get_state(self, name):
+        state = DIIS_helper.get_state(self, name)
+        state[name+"energy"] = self.energy
+        state[name+"P"]      = self.P
+        state[name+"newest"] = np.array(self.newest)
+        if self.density is not None:
+            state[name+"density"] = self.density[:self.nvec]
+        return state
+
+    def set_state(self, name, state):
+        DIIS_helper.set_state(self, name, state)
+        if name+"P" not in state:
+            return
+        self.energy = np.array(state[name+"energy"])
+        self.P      = np.array(state[name+"P"])
+        self.newest = int(state[name+"newest"])
+        if name+"density" in state:
+            density = state[name+"density"]
+            self.density = self._allocate((self.max_vec,) + density.shape[1:], density.dtype)
+            self.density[:self.nvec] = density
+
+    def _model(self):
+        """
+        Linear and quadratic coefficients of the model energy in c.
+        """
+        n = self.nvec
+        P = self.P[:n, :n]
+        k = self.newest
+        if self.mode == "ADIIS":
+            # E(D_k) + sum c_i dD_i.F_k + 1/2 sum c_i c_j dD_i.dF_j
+            g = P[:, k] - P[k, k]
+            M = P - P[:, k][:, None] - P[k, :][None, :] + P[k, k]
+        else:
+            # sum c_i E_i - 1/4 sum c_i c_j (D_i-D_j).(F_i-F_j)
+            g = self.energy[:n].copy()
+            d = np.diag(P)
+            M = -0.5*(d[:, None] + d[None, :] - P - P.T)
+        return g, 0.5*(M + M.T)
+
+    def energy_coefficients(self):
+        """
+        Minimizes the model energy for c_i >= 0, sum c_i = 1 using
+        c_i = t_i^2 / sum t_j^2.
+        """
+        g, M = self._model()
+
+        def fun(t):
+            t2 = t*t
+            S  = t2.sum()
+            c  = t2/S
+            dc = g + M.dot(c)
+            f  = c.dot(g) + 0.5*c.dot(M).dot(c)
+            return f, 2.0*t/S*(dc - c.dot(dc))
+
+        n  = self.nvec
+        t0 = np.ones(n)
+        t0[self.newest] = 2.0
+        res = minimize(fun, t0, jac=True, method="BFGS")
+        c = res.x**2
+        return c/c.sum()
+
+    def extrapolate(self, out=None):
+        """
+        Returns the extrapolated state from the blended coefficients.
+        """
+        if self.nvec == 0:
+            raise Exception("DIIS: No previous vectors.")
+        if self.nvec == 1:
+            self.last_mode = self.mode
+            return self._combine(np.ones(1), out)
+
+        err = np.abs(self.error[self.newest]).max()
+        if err < self.finish:
+            c = self.coefficients()
+            self.last_mode = "DIIS"
+        elif err > self.start:
+            c = self.energy_coefficients()
+            self.last_mode = self.mode
+        else:
+            w = err/self.start
+            c = w*self.energy_coefficients() + (1.0 - w)*self.coefficients()
+            self.last_mode = "BLND"
+
+        return self._combine(c, out)
+
+
+def occupiedCount(C):
+    """
+    Number of nonzero columns of the (occupation weighted) orbitals C
+    """
+    return int(np.count_nonzero(np.abs(np.asarray(C)).max(axis=0)))
+
+
+class IncrementalJK(object):
+    """
+    Builds J and K either from the full density or, in incremental mode,
+    from the change of the density since the previous build,
+    dD = D_n - D_{n-1}, which is accumulated onto the previous J and K.
+
+    dD is passed to the JK object as a low rank factorization
+    dD = L R^T from its eigenpairs; eigenvalues below thresh are dropped.
+    The error this introduces is removed by a full rebuild every full_every
+    builds or whenever force_full() is called.
+
+    An SCF step rotates all occupied orbitals, so dD has a rank of about
+    twice the number of occupied orbitals. The incremental builds of the
+    SCF therefore only pay with a screened (DIRECT) JK, whose cost falls
+    with the size of dD. With a DF JK the cost grows with the number of
+    columns, so there the factorization is only used after set_state
+    (warm start), if its rank is well below the occupied count; the
+    incremental SCF builds are switched off.
+    """
+
+    def __init__(self, jk, incremental=False, full_every=10, thresh=1.0E-8, screened=False):
         """
-        Adds a set of error and state vectors to the DIIS object.
         Parameters
         ----------
-        state : array_like
-            The state vector to add to the DIIS object.
-        error : array_like
-            The error vector to add to the DIIS object.
-        Returns
-        ------
-        None
+        jk : psi4.core.JK
+            Initialized JK object.
+        incremental : bool (default, False)
+            Build from difference densities between full rebuilds.
+        full_every : int (default, 10)
+            Maximum number of incremental builds between full rebuilds.
+        thresh : float (default, 1.0E-8)
+            Eigenvalues of dD below this are neglected.
+        screened : bool (default, False)
+            The JK object screens on the density (DIRECT).
         """
+        if incremental and not screened:
+            psi4.core.print_out("INCFOCK needs SCF_TYPE DIRECT, J/K are built from the full density\n")
+        self.jk          = jk
+        self.incremental = incremental and screened
+        self.screened    = screened
+        self.full_every  = full_every
+        self.thresh      = thresh
 
-        error = np.array(error)
-        state = np.array(state)
-        if len(self.error) > 1:
-            if self.error[-1].shape[0] != error.size:
-                raise Exception("Error vector size does not match previous vector.")
-            if self.vector[-1].shape != state.shape:
-                raise Exception("Vector shape does not match previous vector.")
+        self.D = None
+        self.J = None
+        self.K = None
 
-        self.error.append(error.ravel().copy())
-        self.vector.append(state.copy())
+        self.nsince    = 0
+        self.need_full = True
+        self.last_full = True
+        self.last_rank = None
+        self.seeded    = False
+
+    def get_state(self, name):
+        """
+        Returns the densities and J/K of the last build as a dict of arrays
+        with keys prefixed by name.
+        """
+        if self.D is None:
+            return {}
+        return {name+"D" : np.array(self.D),
+                name+"J" : np.array(self.J),
+                name+"K" : np.array(self.K)}
+
+    def set_state(self, name, state):
+        """
+        Seeds the builder with a state written by get_state (e.g. of the
+        converged ground state); the next build is incremental from it even
+        if incremental builds are off.
+        """
+        if name+"D" not in state:
+            return
+        self.D = [np.array(x) for x in state[name+"D"]]
+        self.J = [np.array(x) for x in state[name+"J"]]
+        self.K = [np.array(x) for x in state[name+"K"]]
+        self.nsince    = 0
+        self.need_full = False
+        self.seeded    = True
 
-    def extrapolate(self):
+    def force_full(self):
         """
-        Performs the DIIS extrapolation for the objects state and error vectors.
+        Request a full rebuild for the next call of compute.
+        """
+        self.need_full = True
+
+    @staticmethod
+    def _store(dst, src):
+        """
+        Copies the matrices src into the arrays of dst, new arrays if
+        there are none yet
+        """
+        if dst is None or len(dst) != len(src):
+            return [np.array(x) for x in src]
+        for d, x in zip(dst, src):
+            np.copyto(d, np.asarray(x))
+        return dst
+
+    def _factor(self, dD):
+        w, v = np.linalg.eigh(dD)
+        keep = np.abs(w) > self.thresh
+        L = v[:, keep] * np.sqrt(np.abs(w[keep]))
+        R = L * np.sign(w[keep])
+        return L, R
+
+    def compute(self, Cocc, D):
+        """
+        Computes J and K for the current densities.
         Parameters
         ----------
-        None
+        Cocc : list of psi4.core.Matrix
+            Occupied (occupation weighted) orbitals, used for full builds.
+        D : list of ndarray
+            Densities Cocc Cocc^T, used for incremental builds.
         Returns
         ------
-        ret : ndarray
-            The extrapolated next state vector
+        (J, K) : tuple of lists of ndarray
+            Coulomb and exchange matrices of every density.
         """
+        factors = None
+        if (self.incremental or self.seeded) and not self.need_full and self.nsince < self.full_every:
+            factors = [self._factor(d - dold) for d, dold in zip(D, self.D)]
+            # without screening no gain unless the rank is well below the
+            # number of occupied (nonzero) orbitals
+            if not self.screened and any(L.shape[1] > occupiedCount(C)//2 for (L, R), C in zip(factors, Cocc)):
+                factors = None
 
-        # Limit size of DIIS vector
-        diis_count = len(self.vector)
+        self.jk.C_clear()
+        if factors is None:
+            for C in Cocc:
+                self.jk.C_left_add(C)
+            self.jk.compute()
+            self.J = self._store(self.J, self.jk.J())
+            self.K = self._store(self.K, self.jk.K())
 
-        if diis_count == 0:
-            raise Exception("DIIS: No previous vectors.")
-        if diis_count == 1:
-            return self.vector[0]
-
-        if diis_count > self.max_vec:
-            # Remove oldest vector
-            del self.vector[0]
-            del self.error[0]
-            diis_count -= 1
-
-        # Build error matrix B
-        B = np.empty((diis_count + 1, diis_count + 1))
-        B[-1, :] = -1
-        B[:, -1] = -1
-        B[-1, -1] = 0
-        for num1, e1 in enumerate(self.error):
-            B[num1, num1] = np.vdot(e1, e1)
-            for num2, e2 in enumerate(self.error):
-                if num2 >= num1: continue
-                val = np.vdot(e1, e2)
-                B[num1, num2] = B[num2, num1] = val
-
-        # normalize
-        B[abs(B) < 1.e-14] = 1.e-14
-        B[:-1, :-1] /= np.abs(B[:-1, :-1]).max()
-
-        # Build residual vector
-        resid = np.zeros(diis_count + 1)
-        resid[-1] = -1
-
-        # Solve pulay equations
-        ci = np.dot(np.linalg.pinv(B), resid)
-
-        # combination of previous fock matrices
-        V = np.zeros_like(self.vector[-1])
-        for num, c in enumerate(ci[:-1]):
-            V += c * self.vector[num]
-
-        return V
+            self.nsince    = 0
+            self.need_full = False
+            self.last_full = True
+            self.last_rank = None
+        else:
+            spins = [n for n, (L, R) in enumerate(factors) if L.shape[1] > 0]
+            for n in spins:
+                self.jk.C_left_add(psi4.core.Matrix.from_array(factors[n][0]))
+                self.jk.C_right_add(psi4.core.Matrix.from_array(factors[n][1]))
+            if len(spins) > 0:
+                self.jk.compute()
+                for c, n in enumerate(spins):
+                    self.J[n] += np.asarray(self.jk.J()[c])
+                    self.K[n] += np.asarray(self.jk.K()[c])
+
+            self.nsince   += 1
+            self.last_full = False
+            self.last_rank = [L.shape[1] for L, R in factors]
+
+        self.seeded = False
+        self.D = self._store(self.D, D)
+        return self.J, self.K
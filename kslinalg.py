@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+Dense linear algebra kernels of the SCF and spectrum code
+
+Only numpy (and scipy if available) is used here, no psi4, so the
+kernels can be benchmarked and checked on their own.
+"""
+import numpy as np
+import tempfile
+try:
+    from scipy.linalg import eigh as scipy_eigh
+except ImportError:
+    scipy_eigh = None
+
+def diag_H(H, A, out=None, work=None, nroots=None):
+    """
+    Orbitals and orbital energies of H in the orthogonal basis A. out
+    receives the orbitals, work (2 x nbf x nbf) holds A H A.
+
+    With nroots only the lowest nroots orbitals are computed, by the
+    LAPACK range driver (MRRR) of scipy if available, and returned in the
+    first columns of out.
+    """
+    if work is None:
+        Hp = A.dot(H).dot(A)
+    else:
+        Hp = np.dot(np.dot(A, H, out=work[0]), A, out=work[1])
+    if nroots is None or nroots >= Hp.shape[0]:
+        e, C2 = np.linalg.eigh(Hp)
+    elif scipy_eigh is not None:
+        e, C2 = scipy_eigh(Hp, subset_by_index=[0, nroots - 1], driver="evr",
+                           overwrite_a=work is not None, check_finite=False)
+    else:
+        e, C2 = np.linalg.eigh(Hp)
+        e, C2 = e[:nroots], C2[:, :nroots]
+    if out is not None:
+        out = out[:, :C2.shape[1]]
+    C = np.matmul(A, C2, out=out)
+    return (C,e)
+
+def diisError(F, D, S, A, out=None, work=None):
+    """
+    Orthogonalized DIIS error F D S - S D F, F, D and S symmetric
+    """
+    if work is None:
+        work = np.empty((2,) + F.shape)
+    FDS = np.dot(np.dot(F, D, out=work[0]), S, out=work[1])
+    np.subtract(FDS, FDS.T, out=work[0])
+    return np.dot(np.dot(A.T, work[0], out=work[1]), A, out=out)
+
+def density(Cocc, out=None):
+    return np.dot(Cocc, Cocc.T, out=out)
+
+def fockMatrix(H, J, K, alpha, V, out=None):
+    """
+    Kohn-Sham matrix H + J - alpha K + V of one spin, J the total Coulomb
+    matrix
+    """
+    F = np.multiply(K, -alpha, out=out)
+    F += H
+    F += J
+    F += V
+    return F
+
+def maxAbs(X):
+    return max(X.max(), -X.min())
+
+def absDiff(X, Y, out):
+    np.subtract(X, Y, out=out)
+    return np.abs(out, out=out)
+
+class DIIS_helper(object):
+    """
+    A helper class to compute DIIS extrapolations.
+    Notes
+    -----
+    Equations taken from [Sherrill:1998], [Pulay:1980:393], & [Pulay:1969:197]
+    Algorithms adapted from [Sherrill:1998] & [Pulay:1980:393]
+
+    State and error vectors are kept in preallocated ring buffers of depth
+    max_vec, the oldest vector is overwritten. Only the row/column of the
+    B matrix belonging to a new vector is computed in add.
+    """
+
+    def __init__(self, max_vec=6, spill_dir=None):
+        """
+        Intializes the DIIS class.
+        Parameters
+        ----------
+        max_vec : int (default, 6)
+            The maximum number of vectors to use. The oldest vector will be deleted.
+        spill_dir : str (default, None)
+            If given, the subspace is kept in memory-mapped temporary files
+            in this directory instead of in memory.
+        """
+        self.max_vec   = max_vec
+        self.spill_dir = spill_dir
+        self.error  = None
+        self.vector = None
+        self.B      = np.zeros((max_vec, max_vec))
+        self.nvec   = 0
+        self.head   = 0
+
+    def _allocate(self, shape, dtype):
+        if self.spill_dir is None:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(tempfile.TemporaryFile(dir=self.spill_dir), dtype=dtype, mode="w+", shape=shape)
+
+    def add(self, state, error):
+        """
+        Adds a set of error and state vectors to the DIIS object.
+        Parameters
+        ----------
+        state : array_like
+            The state vector to add to the DIIS object.
+        error : array_like
+            The error vector to add to the DIIS object.
+        Returns
+        ------
+        None
+        """
+
+        error = np.asarray(error)
+        state = np.asarray(state)
+        if self.vector is None:
+            self.vector = self._allocate((self.max_vec,) + state.shape, state.dtype)
+            self.error  = self._allocate((self.max_vec, error.size), error.dtype)
+        else:
+            if self.error.shape[1] != error.size:
+                raise Exception("Error vector size does not match previous vector.")
+            if self.vector.shape[1:] != state.shape:
+                raise Exception("Vector shape does not match previous vector.")
+
+        slot = self.head
+        self.vector[slot] = state
+        self.error[slot]  = error.reshape(-1)
+
+        self.nvec = min(self.nvec + 1, self.max_vec)
+        self.head = (self.head + 1) % self.max_vec
+
+        # new row/column of B
+        row = self.error[:self.nvec].dot(self.error[slot])
+        self.B[slot, :self.nvec] = row
+        self.B[:self.nvec, slot] = row
+
+    def get_state(self, name):
+        """
+        Returns the subspace as a dict of arrays with keys prefixed by name,
+        e.g. for checkpointing with np.savez.
+        """
+        state = {name+"B"    : self.B,
+                 name+"pos"  : np.array([self.nvec, self.head])}
+        if self.vector is not None:
+            state[name+"vector"] = self.vector[:self.nvec]
+            state[name+"error"]  = self.error[:self.nvec]
+        return state
+
+    def set_state(self, name, state):
+        """
+        Restores a subspace written by get_state.
+        """
+        if name+"B" not in state:
+            return
+        self.B = np.array(state[name+"B"])
+        self.max_vec = self.B.shape[0]
+        self.nvec, self.head = [int(x) for x in state[name+"pos"]]
+        if name+"vector" in state:
+            vector = state[name+"vector"]
+            error  = state[name+"error"]
+            self.vector = self._allocate((self.max_vec,) + vector.shape[1:], vector.dtype)
+            self.error  = self._allocate((self.max_vec,) + error.shape[1:], error.dtype)
+            self.vector[:self.nvec] = vector
+            self.error[:self.nvec]  = error
+
+    def coefficients(self):
+        """
+        Solves the Pulay equations for the current subspace.
+        Returns
+        ------
+        ci : ndarray
+            The coefficients of the stored vectors.
+        """
+        n = self.nvec
+        B = np.empty((n + 1, n + 1))
+        B[:n, :n] = self.B[:n, :n]
+        B[-1, :] = -1
+        B[:, -1] = -1
+        B[-1, -1] = 0
+
+        # normalize
+        scale = np.abs(B[:n, :n]).max()
+        if scale > 0.0:
+            B[:n, :n] /= scale
+
+        # Build residual vector
+        resid = np.zeros(n + 1)
+        resid[-1] = -1
+
+        # Solve pulay equations
+        try:
+            ci = np.linalg.solve(B, resid)
+        except np.linalg.LinAlgError:
+            ci = np.linalg.lstsq(B, resid, rcond=None)[0]
+        return ci[:-1]
+
+    def _combine(self, c, out=None):
+        """
+        sum_i c_i vector_i, into out if given
+        """
+        V = self.vector[:len(c)]
+        if out is None:
+            return np.tensordot(c, V, axes=1)
+        np.dot(c, V.reshape(len(c), -1), out=out.reshape(-1))
+        return out
+
+    def extrapolate(self, out=None):
+        """
+        Performs the DIIS extrapolation for the objects state and error vectors.
+        Parameters
+        ----------
+        out : ndarray (default, None)
+            C-contiguous array that receives the extrapolated state.
+        Returns
+        ------
+        ret : ndarray
+            The extrapolated next state vector
+        """
+
+        if self.nvec == 0:
+            raise Exception("DIIS: No previous vectors.")
+        if self.nvec == 1:
+            return self._combine(np.ones(1), out)
+
+        # combination of previous fock matrices
+        return self._combine(self.coefficients(), out)
+
+
+class OrbitalTracker(object):
+    """
+    Tracks the targeted orbitals of an excited state calculation by their
+    overlap with reference orbitals (maximum overlap method).
+
+    S C_ref is formed once for all tracked orbitals of a spin, every update
+    then needs one GEMM per spin to get all overlaps.
+    """
+
+    def __init__(self, orbitals, S):
+        """
+        Parameters
+        ----------
+        orbitals : list of dict
+            Tracked orbitals, each with the reference coefficients in "C".
+            "orb" and "ovl" of the dicts are kept up to date.
+        S : ndarray
+            AO overlap matrix.
+        """
+        self.orbitals = orbitals
+        self.spins = {}
+        for spin in ["a", "b"]:
+            idx = [n for n, i in enumerate(orbitals) if i["spin"] == spin]
+            if len(idx) == 0:
+                continue
+            Cref = np.array([orbitals[n]["C"] for n in idx]).T
+            self.spins[spin] = {
+                "idx"   : np.array(idx),
+                "SC"    : S.dot(Cref),
+                "orb"   : np.array([orbitals[n]["orb"] for n in idx]),
+                "occ"   : np.array([orbitals[n]["occ"] for n in idx], dtype=float),
+                "DoOvl" : np.array([orbitals[n]["DoOvl"] for n in idx], dtype=bool)}
+
+    def update(self, C, occ, spin, follow_all=False):
+        """
+        Computes the overlaps of the tracked orbitals with the new orbitals,
+        moves the tracked indices to the largest overlap (for DoOvl, or all
+        orbitals if follow_all) and sets their occupations in occ.
+        Returns
+        ------
+        changed : list of tuple
+            (old, new) index of every orbital that moved.
+        """
+        if spin not in self.spins:
+            return []
+        t = self.spins[spin]
+
+        ovl  = np.abs(C.T.dot(t["SC"]))
+        best = np.argmax(ovl, axis=0)
+        old  = t["orb"]
+        if follow_all:
+            new = best
+        else:
+            new = np.where(t["DoOvl"], best, old)
+
+        cols = np.arange(len(new))
+        t["orb"] = new
+        occ[new] = t["occ"]
+
+        for n, o, v in zip(t["idx"], new, ovl[new, cols]):
+            self.orbitals[n]["orb"] = int(o)
+            self.orbitals[n]["ovl"] = v
+
+        return [(int(o), int(n)) for o, n in zip(old, new) if o != n]
+
+
+def freezeShift(F,C,S,frozen,shifted,vshift,out=None,work=None):
+    """
+    Decouples the frozen orbitals from all other orbitals and adds vshift
+    to the diagonal of the shifted (virtual) orbitals, both in the MO basis
+    of the S-orthonormal orbitals C. C may hold only the lowest orbitals
+    (see DIAG_NVIRT), the missing ones count as shifted.
+
+    C^T S is the inverse of C, so the projector onto orbitals I in the AO
+    basis is S C_I C_I^T S and both are applied as one low rank update
+
+        F' = F - Y G^T - G Y^T + Y (g + diag g) Y^T + vshift (S - Z Z^T)
+
+    Y = S C_f, G = F C_f, g = C_f^T F C_f for the frozen orbitals f and
+    Z = S C_n for the orbitals n that are not shifted (the occupied ones),
+    the rank is twice the number of frozen orbitals plus the number of
+    occupied orbitals.
+
+    Parameters
+    ----------
+    frozen : list of int
+        Indices of the frozen orbitals.
+    shifted : list of int or bool ndarray
+        Indices or mask of the shifted orbitals of C.
+    out : ndarray
+        Receives F', may be F.
+    work : ndarray
+        nbf x nbf scratch array.
+    """
+    frozen = np.asarray(frozen, dtype=int)
+    keep   = np.ones(C.shape[1], dtype=bool)
+    keep[shifted] = False
+    shift  = (vshift != 0.0) and (keep.sum() < F.shape[0])
+
+    # update U V^T, V = U times the symmetric coefficient matrix
+    U = []
+    V = []
+    if len(frozen) > 0:
+        Cf = C[:, frozen]
+        Y  = S.dot(Cf)
+        G  = F.dot(Cf)
+        g  = Cf.T.dot(G)
+        U += [Y, G]
+        V += [Y.dot(g + np.diag(np.diag(g))) - G, -Y]
+    if shift:
+        Z  = S.dot(C[:, keep])
+        U += [Z]
+        V += [-vshift*Z]
+
+    if out is None:
+        out = np.array(F)
+    elif out is not F:
+        np.copyto(out, F)
+    if len(U) > 0:
+        out += np.dot(np.hstack(U), np.hstack(V).T, out=work)
+    if shift:
+        out += np.multiply(S, vshift, out=work)
+    return out
+
+def transitionDipoles(C,D,orbI,orbF):
+    """
+    Transition dipole moments <i|r|f> of all initial orbitals orbI and
+    final orbitals orbF. Only the initial orbitals are contracted with the
+    AO dipole integrals D (3 x nbf x nbf), which is O(nbf^2) per orbital.
+
+    Returns
+    -------
+    M : ndarray
+        3 x len(orbI) x len(orbF)
+    """
+    Ci = np.asarray(C)[:,orbI]
+    Cf = np.asarray(C)[:,orbF]
+    return np.array([(Ci.T @ Dk) @ Cf for Dk in D])
+
+def oscillatorStrengths(En,M):
+    """
+    f = 2/3 dE |<i|r|f>|^2 (atomic units)
+    """
+    return 2.0/3.0*En*np.sum(M**2,axis=0)
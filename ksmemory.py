@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Memory planner: choice of the JK algorithm and its memory
+
+The sizes of the DF tensor, the DIIS subspace and the Fock/density work
+arrays are estimated from nbf, naux and the number of occupied orbitals.
+An explicit SCF_TYPE (set scf scf_type ...) is always used; otherwise
+MEM_DF is chosen if everything fits into the psi4 memory, DISK_DF if only
+the work arrays fit and the scratch disk can hold the tensor, and DIRECT
+if neither.
+"""
+import shutil
+import psi4
+from .kshelper import peakRSS
+
+
+DF_TYPES = ["DF", "MEM_DF", "DISK_DF"]
+
+# fraction of the psi4 memory that may be planned
+SAFETY = 0.9
+
+# nbf x nbf work arrays of the SCF loops: S, A, H, T, V, F, D, J, K, V_xc,
+# old F/D and DIIS error for both spins, C and Cocc
+NWORK = 30
+
+
+def estimateMemory(nbf, naux, nalpha, nbeta, max_vec=6, mix="DAMP", npairs=None):
+    """
+    Estimated sizes in bytes.
+
+    Returns
+    -------
+    est : dict
+        df      : (Q|mn) tensor of npairs function pairs
+        df_work : buffers of the DF J/K build (occupied half transform)
+        diis    : DIIS subspaces
+        work    : nbf^2 work arrays of the SCF loops
+    """
+    if npairs is None:
+        npairs = nbf*(nbf + 1)//2
+    nbf2 = nbf*nbf*8
+    est = {"df"      : naux*npairs*8,
+           "df_work" : naux*nbf*max(nalpha, nbeta)*8,
+           "work"    : NWORK*nbf2}
+    # alpha and beta DIIS (vectors + errors), plus the joint ADIIS/EDIIS
+    # subspace that also keeps the densities
+    est["diis"] = 2*2*max_vec*nbf2
+    if mix in ["ADIIS", "EDIIS"]:
+        est["diis"] += 3*2*max_vec*nbf2
+    return est
+
+
+def requestedSCFType():
+    """
+    SCF_TYPE set by the user (SCF module or global), None if not set
+    """
+    if psi4.core.has_option_changed("SCF", "SCF_TYPE"):
+        return psi4.core.get_option("SCF", "SCF_TYPE")
+    if psi4.core.has_global_option_changed("SCF_TYPE"):
+        return psi4.core.get_global_option("SCF_TYPE")
+    return None
+
+
+def planJK(nbf, naux, nalpha, nbeta, mix="DAMP", npairs=None):
+    """
+    Chooses the JK algorithm. npairs is the number of significant
+    function pairs the (Q|mn) tensor is stored for, default all.
+
+    Returns
+    -------
+    plan : dict
+        jk_type, jk_memory (doubles), spill_diis, the estimates and the
+        available memory (bytes)
+    """
+    memory = psi4.core.get_memory()
+    est    = estimateMemory(nbf, naux, nalpha, nbeta, mix=mix, npairs=npairs)
+    avail  = SAFETY*memory
+    rest   = est["work"] + est["diis"]
+
+    scratch = psi4.core.IOManager.shared_object().get_default_path()
+    try:
+        disk = shutil.disk_usage(scratch).free
+    except OSError:
+        disk = 0
+
+    requested = requestedSCFType()
+    if requested is not None:
+        jk_type = requested
+        if jk_type == "DF":
+            jk_type = "MEM_DF" if est["df"] + est["df_work"] + rest <= avail else "DISK_DF"
+        reason = "SCF_TYPE"
+    elif est["df"] + est["df_work"] + rest <= avail:
+        jk_type, reason = "MEM_DF", "tensor fits in memory"
+    elif est["df"] <= disk:
+        jk_type, reason = "DISK_DF", "tensor does not fit in memory"
+    else:
+        jk_type, reason = "DIRECT", "tensor does not fit in memory or on disk"
+
+    # the DIIS subspace goes to scratch if it does not fit next to the tensor
+    need = est["work"] + est["diis"] + _jkMemory(jk_type, est)
+    spill = need > avail
+
+    jk_memory = int((avail - est["work"] - (0 if spill else est["diis"]))/8)
+    jk_memory = max(jk_memory, int(0.1*memory/8))
+
+    plan = {"jk_type"    : jk_type,
+            "reason"     : reason,
+            "jk_memory"  : jk_memory,
+            "spill_diis" : spill,
+            "memory"     : memory,
+            "disk"       : disk,
+            "estimate"   : est}
+    return plan
+
+
+def _jkMemory(jk_type, est):
+    if jk_type == "MEM_DF":
+        return est["df"] + est["df_work"]
+    if jk_type in DF_TYPES:
+        return est["df_work"]
+    return 0
+
+
+def printPlan(plan):
+    """
+    Prints the memory plan
+    """
+    MB  = 1024.0**2
+    est = plan["estimate"]
+    psi4.core.print_out("\nMemory plan:\n"+12*"="+"\n\n")
+    psi4.core.print_out("{:>24} {:10.1f} MB\n".format("Available:", plan["memory"]/MB))
+    psi4.core.print_out("{:>24} {:10.1f} MB\n".format("Scratch disk:", plan["disk"]/MB))
+    for key, title in [("df", "DF tensor:"), ("df_work", "DF work:"), ("diis", "DIIS subspace:"), ("work", "SCF work arrays:")]:
+        psi4.core.print_out("{:>24} {:10.1f} MB\n".format(title, est[key]/MB))
+    psi4.core.print_out("{:>24} {} ({})\n".format("JK:", plan["jk_type"], plan["reason"]))
+    psi4.core.print_out("{:>24} {:10.1f} MB\n".format("JK memory:", plan["jk_memory"]*8/MB))
+    psi4.core.print_out("{:>24} {}\n\n".format("DIIS in scratch:", "Yes" if plan["spill_diis"] else "No"))
+
+
+def plannedMB(plan):
+    """
+    Estimated peak of the plan in MB
+    """
+    est = plan["estimate"]
+    total = est["work"] + _jkMemory(plan["jk_type"], est)
+    if not plan["spill_diis"]:
+        total += est["diis"]
+    return total/1024.0**2
+
+
+def printMemoryUsage(title, plan):
+    """
+    Prints the peak resident memory of the process against the plan
+    """
+    psi4.core.print_out("{:>24} {:10.1f} MB (estimate {:.1f} MB, {})\n\n".format(
+        title+" peak memory:", peakRSS(), plannedMB(plan), plan["jk_type"]))
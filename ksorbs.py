@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Orbital files (PREFIX_gsorbs.npz, PREFIX_exorbs.npz)
+
+The files are uncompressed .npz archives. OrbitalStore opens an archive
+once and serves its members as memory-mapped arrays, read on first
+access; coefficient matrices are stored in Fortran order so that a subset
+of orbitals (columns) is contiguous on disk. The tracked orbitals of an
+excited state are kept as plain arrays, not as a pickled object array.
+"""
+import struct
+import zipfile
+import numpy as np
+from .kshelper import atomicSavez
+
+
+# plain array columns describing the tracked orbitals
+ORBITAL_KEYS = [("orb", "orb_index", int), ("spin", "orb_spin", str), ("occ", "orb_occ", float),
+                ("frz", "orb_frz", bool), ("DoOvl", "orb_doovl", bool), ("ovl", "orb_ovl", float)]
+
+
+def writeOrbitals(filename, Ca, Cb, occa, occb, epsa, epsb, orbitals=None, **extra):
+    """
+    Writes an orbital file atomically. orbitals (list of dict) is stored
+    as one plain array per key plus the reference coefficients orb_C.
+    """
+    arrays = {"Ca"   : np.asfortranarray(Ca),
+              "Cb"   : np.asfortranarray(Cb),
+              "occa" : occa, "occb" : occb,
+              "epsa" : epsa, "epsb" : epsb}
+    if orbitals is not None:
+        for key, name, dtype in ORBITAL_KEYS:
+            arrays[name] = np.array([dtype(i.get(key, 0)) for i in orbitals])
+        if len(orbitals) > 0 and "C" in orbitals[0]:
+            arrays["orb_C"] = np.asfortranarray(np.array([i["C"] for i in orbitals]).T)
+    arrays.update(extra)
+    atomicSavez(filename, **arrays)
+
+
+class OrbitalStore(object):
+    """
+    Lazy, memory-mapped read access to an orbital file.
+
+    >>> orbs = OrbitalStore("KS_gsorbs.npz")
+    >>> Cocc = orbs.occupied("b")      # only the occupied columns
+    >>> occa = orbs["occa"]
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._arrays  = {}
+        self._members = {}
+        self._map     = None
+
+        # locate the raw data of every member once
+        with open(filename, "rb") as f, zipfile.ZipFile(f) as zf:
+            for info in zf.infolist():
+                name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+                if info.compress_type != zipfile.ZIP_STORED:
+                    self._members[name] = None
+                    continue
+                f.seek(info.header_offset + 26)
+                nlen, xlen = struct.unpack("<HH", f.read(4))
+                f.seek(info.header_offset + 30 + nlen + xlen)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+                if dtype.hasobject:
+                    self._members[name] = None
+                else:
+                    self._members[name] = (f.tell(), shape, fortran, dtype)
+
+    def keys(self):
+        return self._members.keys()
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            member = self._members[name]
+            if member is None:
+                # compressed member of an old file, read it in full
+                self._arrays[name] = np.load(self.filename)[name]
+            else:
+                offset, shape, fortran, dtype = member
+                if int(np.prod(shape)) == 0:
+                    self._arrays[name] = np.zeros(shape, dtype=dtype)
+                else:
+                    if self._map is None:
+                        self._map = np.memmap(self.filename, dtype=np.uint8, mode="r")
+                    self._arrays[name] = np.ndarray(shape, dtype=dtype, buffer=self._map, offset=offset,
+                                                    order="F" if fortran else "C")
+        return self._arrays[name]
+
+    def C(self, spin):
+        return self["C"+spin]
+
+    def occ(self, spin):
+        return self["occ"+spin]
+
+    def eps(self, spin):
+        return self["eps"+spin]
+
+    def occupied(self, spin):
+        """
+        Coefficients of the (partially) occupied orbitals of a spin
+        """
+        idx = np.nonzero(self.occ(spin))[0]
+        return self.C(spin)[:, idx]
+
+    def orbital(self, spin, idx):
+        """
+        Coefficients of orbital(s) idx of a spin
+        """
+        return self.C(spin)[:, idx]
+
+    def orbitals(self):
+        """
+        Tracked orbitals as list of dicts, as used by DFTExcitedState
+        """
+        if "orb_index" not in self:
+            if "orbitals" in self:
+                raise Exception("{} stores pickled orbitals, rerun the EX step.".format(self.filename))
+            return []
+        cols = [(key, self[name]) for key, name, dtype in ORBITAL_KEYS if name in self]
+        orbitals = []
+        for n in range(len(self["orb_index"])):
+            i = {key: col[n].item() for key, col in cols}
+            if "orb_C" in self:
+                i["C"] = self["orb_C"][:, n]
+            orbitals.append(i)
+        return orbitals
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-site core-hole driver
+
+Runs one excited state calculation (and optionally its spectrum) per
+core-hole site. All sites start from the same ground state orbitals;
+every site works in its own directory PREFIX_site<N> with prefix
+PREFIX_site<N>, so none of the output files collide. The results are
+merged in the calling process.
+
+With SITE_PROCS 1 (default) the sites run one after the other in the
+calling process and share its KSContext. Otherwise they run in a pool of
+spawned processes: forking a process with a live OpenMP pool can hang, and
+forked workers would share the open DF scratch files of the parent. Every
+worker therefore starts a fresh psi4 with the psi4 and PSIXAS options,
+memory share and molecule of the parent and builds its own KSContext.
+"""
+import concurrent.futures
+import copy
+import multiprocessing
+import os
+import json
+import psi4
+import psi4.driver.p4util as p4util
+from .kscontext import KSContext
+from .ksex import DFTExcitedState
+from .spec import CalcSpec,groundStateEnergy
+from .ksexport import waitExports
+from .ksspectrum import writeSpectra
+
+# state of the site runs: set directly for serial runs, by _initWorker in
+# spawned workers
+_shared = {}
+
+
+def _initWorker(state):
+    """
+    Initializer of a spawned worker: psi4 memory, threads, options and
+    molecule of the parent. The KSContext is built with the first site.
+    """
+    _shared.update(state)
+    psi4.set_memory(state["memory"])
+    psi4.set_num_threads(state["threads"])
+    psi4.set_options(state["options"])
+    psi4.set_options(state["psixas"])
+    # the worker must run with the PSIXAS options of the parent
+    lost = [key for key, value in state["psixas"].items()
+            if psi4.core.get_local_option("PSIXAS", key[len("psixas__"):].upper()) != value]
+    if len(lost) > 0:
+        raise Exception("PSIXAS options {} not set in the site worker".format(", ".join(lost)))
+    mol = psi4.geometry(state["geometry"])
+    mol.update_geometry()
+    _shared["mol"] = mol
+    _shared["ctx"] = None
+
+
+def _runSite(n, orbs):
+    """
+    Excited state (+ spectrum) calculation of site n, in its own directory
+    """
+    mol      = _shared["mol"]
+    func     = _shared["func"]
+    prefix   = _shared["prefix"]
+
+    siteprefix = "{}_site{:d}".format(prefix, n)
+    sitedir    = os.path.join(_shared["cwd"], siteprefix)
+    os.makedirs(sitedir, exist_ok=True)
+    os.chdir(sitedir)
+    try:
+        if _shared["spawned"]:
+            psi4.core.set_output_file(siteprefix+".out", False)
+        else:
+            psi4.core.print_out("\nSite {:d}: {}\n".format(n, siteprefix))
+        if _shared["ctx"] is None:
+            _shared["ctx"] = KSContext(mol, func)
+        ctx = _shared["ctx"]
+
+        orbitals = copy.deepcopy(_shared["orbitals"])
+        for i, orb in zip(orbitals, orbs):
+            i["orb"] = orb
+
+        gsprefix = os.path.join(_shared["cwd"], prefix)
+        DFTExcitedState(mol, func, orbitals, PREFIX=siteprefix, GSPREFIX=gsprefix, CTX=ctx)
+        result = {"site"   : n,
+                  "orbs"   : list(orbs),
+                  "energy" : psi4.core.scalar_variable('CURRENT ENERGY'),
+                  "dir"    : sitedir,
+                  "prefix" : siteprefix}
+
+        if _shared["spec"]:
+            result["spectrum"] = CalcSpec(mol, func, PREFIX=siteprefix, GSPREFIX=gsprefix,
+                                          CTX=ctx, SITE=n)
+
+        # a worker process must not exit before its export is written
+        waitExports()
+        psi4.core.flush_outfile()
+    finally:
+        os.chdir(_shared["cwd"])
+    return result
+
+
+def _psixasOptions():
+    """
+    PSIXAS options the user changed, as psixas__<name> for psi4.set_options.
+    prepare_options_for_set_options only covers psi4's own modules.
+    """
+    options = {}
+    for name in psi4.core.options_to_python("PSIXAS"):
+        if psi4.core.has_local_option_changed("PSIXAS", name):
+            options["psixas__"+name.lower()] = psi4.core.get_local_option("PSIXAS", name)
+    return options
+
+
+def _workerState(mol, nprocs, threads):
+    """
+    What a spawned worker needs to rebuild the psi4 state of the parent
+    """
+    # the parent's orientation, the ground state orbitals belong to it
+    geometry = mol.create_psi4_string_from_molecule() + "\nno_com\nno_reorient\n"
+    return {"geometry" : geometry,
+            "options"  : p4util.prepare_options_for_set_options(),
+            "psixas"   : _psixasOptions(),
+            "memory"   : max(psi4.get_memory()//nprocs, 250*1024**2),
+            "threads"  : threads,
+            "spawned"  : True}
+
+
+def parseSites(sites, norbs):
+    """
+    Each entry of SITES replaces the ORBS array for one site. A plain
+    number is accepted if ORBS has a single entry.
+    """
+    parsed = []
+    for site in sites:
+        if not isinstance(site, list):
+            site = [site]
+        if len(site) != norbs:
+            raise Exception("SITES entry {} does not match the length of ORBS".format(site))
+        parsed.append([int(x) for x in site])
+    return parsed
+
+
+def RunSites(mol, func, orbitals, sites, **kwargs):
+    """
+    Run the excited state of every site, serially or in a process pool
+    (SITE_PROCS).
+
+    Parameters
+    ----------
+    orbitals : list of dict
+        Orbital definitions from ORBS/OCCS/..., used as template.
+    sites : list
+        Orbital indices of every site, see parseSites.
+    kwargs : PREFIX, CTX, SPEC (also compute spectra)
+    """
+    prefix  = kwargs.get("PREFIX", psi4.core.get_local_option("PSIXAS", "PREFIX"))
+    threads = psi4.core.get_local_option("PSIXAS", "SITE_THREADS")
+    nprocs  = psi4.core.get_local_option("PSIXAS", "SITE_PROCS")
+    if nprocs < 1:
+        nprocs = max(1, (os.cpu_count() or 1)//threads)
+
+    sites  = parseSites(sites, len(orbitals))
+    nprocs = min(nprocs, len(sites))
+    if nprocs == 1:
+        threads = psi4.core.get_num_threads()
+
+    psi4.core.print_out("\n\nMulti-site excited states:\n"+26*"="+"\n\n")
+    psi4.core.print_out("{:>10} {:d}\n{:>10} {:d}\n{:>10} {:d}\n\n".format("SITES:", len(sites), "PROCS:", nprocs, "THREADS:", threads))
+    psi4.core.flush_outfile()
+
+    state = {"func"     : func,
+             "prefix"   : prefix,
+             "orbitals" : orbitals,
+             "spec"     : kwargs.get("SPEC", False),
+             "cwd"      : os.getcwd()}
+
+    # no export thread may be running while the sites start
+    waitExports()
+
+    if nprocs == 1:
+        _shared.update(state)
+        _shared.update({"mol": mol, "ctx": kwargs.get("CTX"), "spawned": False})
+        results = [_runSite(n, orbs) for n, orbs in enumerate(sites)]
+    else:
+        state.update(_workerState(mol, nprocs, threads))
+        mpctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs, mp_context=mpctx,
+                                                    initializer=_initWorker, initargs=(state,)) as pool:
+            futures = [pool.submit(_runSite, n, orbs) for n, orbs in enumerate(sites)]
+            results = [f.result() for f in futures]
+
+    psi4.core.print_out("{:^5}|{:^20}|{:^16}|{:^12}\n".format("Site", "ORBS", "E [Ha]", "dE [eV]"))
+    psi4.core.print_out(56*"-"+"\n")
+    gsE = groundStateEnergy(prefix)
+    for r in results:
+        dE = (r["energy"] - gsE)*27.211385 if gsE is not None else 0.0
+        psi4.core.print_out("{:^5}|{:^20}|{:16.8f}|{:12.4f}\n".format(r["site"], str(r["orbs"]), r["energy"], dE))
+    psi4.core.print_out("\n")
+
+    with open(prefix+'_sites.json', 'w') as handle:
+        json.dump([{k: v for k, v in r.items() if k != "spectrum"} for r in results], handle, indent=1)
+    psi4.core.print_out("{}_sites.json written.. \n".format(prefix))
+
+    if state["spec"]:
+        gsmeta = {} if gsE is None else {"gs_energy": gsE}
+        blocks = [(spec, dict(gsmeta, site=r["site"], spin=spin, orbs=r["orbs"], energy=r["energy"],
+                              prefix=r["prefix"]))
+                  for r in results for spin, spec in sorted(r["spectrum"].items())]
+        writeSpectra(prefix+'_sites.spectrum', blocks)
+        psi4.core.print_out("{}_sites.spectrum written.. \n".format(prefix))
+    psi4.core.print_out("\n")
+
+    return results
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Spectrum files (PREFIX.spectrum, PREFIX_sites.spectrum)
+
+A spectrum file is a sequence of blocks, one per stick spectrum (one spin
+of one core hole, site or snapshot). Every block consists of
+
+    8 bytes   magic "PSXSPEC1"
+    8 bytes   length of the JSON header (little endian)
+    header    JSON: number of sticks, metadata, column dtypes and offsets
+    data      the columns, each contiguous and 64 byte aligned
+
+so appending a spectrum never touches the existing data, and a column is
+read as a memory-mapped view without unpickling anything. A block that was
+cut short by a crash during an append is skipped with a warning, reading
+resumes at the next magic.
+"""
+import json
+import mmap
+import os
+import struct
+import warnings
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+MAGIC = b"PSXSPEC1"
+
+ALIGN = 64
+
+# columns of every block; spin is "a" or "b", orbI/orbF are orbital indices,
+# epsI is the orbital energy of the initial orbital
+SPECTRUM_COLUMNS = [("En", "<f8"), ("Dx", "<f8"), ("Dy", "<f8"), ("Dz", "<f8"), ("f", "<f8"),
+                    ("spin", "<U1"), ("orbI", "<i8"), ("orbF", "<i8"), ("epsI", "<f8")]
+
+
+def _pad(n):
+    return (-n) % ALIGN
+
+
+def _block(spec, meta):
+    """
+    Bytes of one block for the spectrum dict spec
+    """
+    n = len(spec["En"])
+    columns = []
+    data = []
+    offset = 0
+    for name, dtype in SPECTRUM_COLUMNS:
+        if name == "spin" and name not in spec:
+            col = np.full(n, meta.get("spin", ""), dtype=dtype)
+        elif name == "epsI" and name not in spec:
+            col = np.full(n, np.nan, dtype=dtype)
+        else:
+            col = np.ascontiguousarray(spec[name], dtype=dtype)
+        if col.shape != (n,):
+            raise Exception("Spectrum column {} has {} entries, expected {:d}".format(name, col.shape, n))
+        raw = col.tobytes()
+        columns.append([name, dtype, offset])
+        data.append(raw + b"\0"*_pad(len(raw)))
+        offset += len(raw) + _pad(len(raw))
+
+    header = json.dumps({"n": n, "meta": meta, "columns": columns, "size": offset}).encode()
+    header += b" "*_pad(len(header) + 16)
+    return MAGIC + struct.pack("<Q", len(header)) + header + b"".join(data)
+
+
+def writeSpectra(filename, blocks):
+    """
+    Writes a new spectrum file (atomically) from a list of (spec, meta)
+    """
+    tmp = filename + ".tmp{:d}".format(os.getpid())
+    with open(tmp, "wb") as f:
+        for spec, meta in blocks:
+            f.write(_block(spec, meta))
+    os.replace(tmp, filename)
+
+
+def appendSpectrum(filename, spec, **meta):
+    """
+    Appends one spectrum dict (En, Dx, Dy, Dz, f, orbI, orbF, spin) with its
+    metadata (e.g. site, spin, energy) to filename, creating it if needed.
+    """
+    block = _block(spec, meta)
+    with open(filename, "ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class SpectrumFile(object):
+    """
+    Read access to a spectrum file; columns are memory mapped.
+
+    >>> sf = SpectrumFile("WATER.spectrum")
+    >>> En = sf.column("En")                       # all blocks
+    >>> f  = sf.column("f", sf.find(spin="b"))     # beta blocks only
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.blocks   = []
+        self._map     = None
+        self.skipped  = []
+
+        size = os.path.getsize(filename)
+        if size == 0:
+            return
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:8] != MAGIC:
+                raise Exception("{} is not a spectrum file".format(filename))
+            pos = 0
+            while pos < size:
+                header = self._header(m, pos, size)
+                if header is None:
+                    # truncated or damaged block, resync at the next magic
+                    nxt = m.find(MAGIC, pos + 1)
+                    end = size if nxt < 0 else nxt
+                    self.skipped.append((pos, end))
+                    warnings.warn("{}: skipped invalid block at bytes {:d}-{:d}".format(filename, pos, end))
+                    pos = end
+                    continue
+                self.blocks.append(header)
+                pos = header["start"] + header["size"]
+
+    @staticmethod
+    def _header(m, pos, size):
+        """
+        Header of the block at byte pos, None if the block is incomplete:
+        a complete block ends at the end of the file or at the next magic.
+        """
+        if pos + 16 > size or m[pos:pos+8] != MAGIC:
+            return None
+        hlen  = struct.unpack("<Q", m[pos+8:pos+16])[0]
+        start = pos + 16 + hlen
+        if start > size:
+            return None
+        try:
+            header = json.loads(m[pos+16:start].decode())
+            end = start + int(header["size"])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if end > size or (end < size and m[end:end+8] != MAGIC):
+            return None
+        header["start"] = start
+        return header
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def meta(self, block=None):
+        """
+        Metadata of one block, or of all blocks
+        """
+        if block is None:
+            return [b["meta"] for b in self.blocks]
+        return self.blocks[block]["meta"]
+
+    def find(self, **match):
+        """
+        Indices of the blocks whose metadata has all the given values
+        """
+        return [n for n, b in enumerate(self.blocks)
+                if all(b["meta"].get(k) == v for k, v in match.items())]
+
+    def nsticks(self, blocks=None):
+        """
+        Number of sticks of every block
+        """
+        if blocks is None:
+            blocks = range(len(self.blocks))
+        return np.array([self.blocks[n]["n"] for n in blocks], dtype=int)
+
+    def _column(self, block, name):
+        b = self.blocks[block]
+        for cname, dtype, offset in b["columns"]:
+            if cname == name:
+                if b["n"] == 0:
+                    return np.zeros(0, dtype=dtype)
+                if self._map is None:
+                    self._map = np.memmap(self.filename, dtype=np.uint8, mode="r")
+                return np.ndarray((b["n"],), dtype=dtype, buffer=self._map, offset=b["start"] + offset)
+        raise Exception("Spectrum file {} has no column {}".format(self.filename, name))
+
+    def column(self, name, blocks=None):
+        """
+        Column name of the given blocks (default: all) as one array; a view
+        into the file if it is a single block.
+        """
+        if blocks is None:
+            blocks = range(len(self.blocks))
+        blocks = list(blocks)
+        if len(blocks) == 1:
+            return self._column(blocks[0], name)
+        if len(blocks) == 0:
+            return np.zeros(0, dtype=dict(SPECTRUM_COLUMNS)[name])
+        return np.concatenate([self._column(n, name) for n in blocks])
+
+    def blockIndex(self, blocks=None):
+        """
+        Block number of every stick of column(..., blocks)
+        """
+        if blocks is None:
+            blocks = range(len(self.blocks))
+        blocks = list(blocks)
+        return np.repeat(np.array(blocks, dtype=int), self.nsticks(blocks))
+
+    def spectrum(self, block):
+        """
+        One block as spectrum dict, as returned by CalcSpec
+        """
+        return {name: self._column(block, name) for name, dtype in SPECTRUM_COLUMNS}
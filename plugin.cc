@@ -46,14 +46,82 @@ int read_options(std::string name, Options& options)
         options.add_str("PREFIX", "KS");
         options.add_double("DAMP", 0.8);
         options.add_double("DIIS_EPS", 0.1);
+        /*- SCF convergence accelerator, DAMP switches from damping to DIIS at DIIS_EPS -*/
+        options.add_str("MIX", "DAMP", "DAMP ADIIS EDIIS");
 	options.add_double("VSHIFT",0.0);
 	options.add_int("MAXITER",100);
+        /*- Restricted (one spin channel) ground state: AUTO for closed shells -*/
+        options.add_str("GS_RESTRICTED", "AUTO", "AUTO YES NO");
+        /*- Initial guess of the ground state without restart file -*/
+        options.add_str("GUESS", "CORE", "CORE SAD BASIS");
+        /*- Basis set of the ground state projected for GUESS BASIS -*/
+        options.add_str("GUESS_BASIS", "DEF2-SVP");
+        /*- Seed the excited state with the ground state Fock and J/K -*/
+        options.add_bool("WARMSTART", false);
+        /*- Resume the excited state SCF from PREFIX_exchk.npz if present -*/
+        options.add_bool("RESTART", false);
+        /*- Write an excited state checkpoint every n iterations, 0 never. A checkpoint
+            holds C, F and the DIIS subspaces (several GB for large nbf) -*/
+        options.add_int("CHKPT_ITER", 0);
+        /*- Write an excited state checkpoint every n seconds, 0 never -*/
+        options.add_double("CHKPT_TIME", 0.0);
         options.add_array("ORBS");
         options.add_array("OCCS");
         options.add_array("SPIN");
         options.add_array("FREEZE");
 	options.add_array("OVL");
         options.add_array("LOC_SUB"); 
+        /*- Write the SCF profile to PREFIX_gs_profile.json/PREFIX_ex_profile.json -*/
+        options.add_bool("PROFILE", false);
+        /*- Write GENBAS/OLDMOS for CFOUR: NONE, SYNC or in a BACKGROUND thread -*/
+        options.add_str("CFOUR_EXPORT", "SYNC", "NONE SYNC BACKGROUND");
+        /*- Core-hole sites, each entry replaces ORBS for one excited state -*/
+        options.add_array("SITES");
+        /*- Number of sites run in parallel (spawned psi4 processes), 1 serial, 0 uses all cores -*/
+        options.add_int("SITE_PROCS", 1);
+        /*- Number of threads of every site process (SITE_PROCS > 1) -*/
+        options.add_int("SITE_THREADS", 1);
+        /*- Keep the DIIS subspace in scratch files from this nbf on, 0 never -*/
+        options.add_int("DIIS_SPILL_NBF", 0);
+        /*- Virtual orbitals diagonalized per SCF iteration above the occupied/tracked ones, -1 all.
+            Pays off for large basis sets (nbf in the thousands) where the full diagonalization
+            dominates an iteration and needs scipy; all orbitals are still computed at convergence.
+            Orbital tracking only sees the computed orbitals, so keep a margin of virtuals -*/
+        options.add_int("DIAG_NVIRT", -1);
+        /*- Run the alpha and beta steps of an SCF iteration in two threads -*/
+        options.add_bool("PARALLEL_SPINS", false);
+        /*- Build J/K from difference densities between full rebuilds, SCF_TYPE DIRECT only -*/
+        options.add_bool("INCFOCK", false);
+        /*- Maximum number of incremental J/K builds between full rebuilds -*/
+        options.add_int("INCFOCK_FULL_EVERY", 10);
+        /*- Eigenvalues of the difference density neglected in incremental builds -*/
+        options.add_double("INCFOCK_THRESH", 1.0E-8);
+        /*- Directory of the persistent AO integral cache, empty disables it -*/
+        options.add_str_i("CACHE_DIR", "");
+        /*- Maximum size of the integral cache in MB -*/
+        options.add_int("CACHE_MAX_SIZE", 2048);
+        /*- Start the SCF on a coarse DFT grid and switch to the target grid -*/
+        options.add_bool("COARSE_GRID", false);
+        /*- Spherical points of the coarse grid -*/
+        options.add_int("COARSE_SPHERICAL_POINTS", 110);
+        /*- Radial points of the coarse grid -*/
+        options.add_int("COARSE_RADIAL_POINTS", 50);
+        /*- Basis function screening of the coarse grid -*/
+        options.add_double("COARSE_BASIS_TOLERANCE", 1.0E-10);
+        /*- Switch to the target grid once |dE| is below this -*/
+        options.add_double("COARSE_E_SWITCH", 1.0E-4);
+        /*- ... or once the largest DIIS error is below this -*/
+        options.add_double("COARSE_D_SWITCH", 1.0E-2);
+        /*- MODE SUM: shift every site by its Delta-KS IONIZATION or EXCITATION energy -*/
+        options.add_str("SPEC_ALIGN", "IONIZATION", "NONE IONIZATION EXCITATION");
+        /*- MODE SUM: energy grid [Emin, Emax, Npts] in eV, empty for automatic -*/
+        options.add_array("SPEC_GRID");
+        /*- MODE SUM: FWHM of the broadening in eV (Gaussian part of VOIGT) -*/
+        options.add_double("SPEC_FWHM", 1.0);
+        /*- MODE SUM: Lorentzian FWHM in eV of SPEC_SHAPE VOIGT -*/
+        options.add_double("SPEC_FWHM_L", 0.5);
+        /*- MODE SUM: line shape of the broadening -*/
+        options.add_str("SPEC_SHAPE", "GAUSS", "GAUSS LORENTZ VOIGT");
         
     }
 
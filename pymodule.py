@@ -27,6 +27,7 @@
 #
 # @END LICENSE
 #
+import os
 import sys
 import numpy as np
 import psi4
@@ -35,6 +36,12 @@ from psi4.driver.procrouting import proc_util
 from .ksgs import DFTGroundState
 from .ksex import DFTExcitedState
 from .spec import CalcSpec
+from .kscontext import KSContext
+from .kssites import RunSites
+from .ksorbs import OrbitalStore,writeOrbitals
+from .ksexport import waitExports
+from .ksaggregate import AggregateSpectra
+from .kshelper import atomicSavez
 
 
 def run_psixas(name, **kwargs):
@@ -55,30 +62,30 @@ def run_psixas(name, **kwargs):
 
     tmp = psi4.core.get_local_option("PSIXAS","MODE")
     mode = tmp.split("+")
-    if not(all([x in ["GS","LOC","EX","SPEC"] for x in mode])):
-        raise Exception("Wrong mode, possible values are GS, LOC, EX, SPEC.")
+    if not(all([x in ["GS","LOC","EX","SPEC","SUM"] for x in mode])):
+        raise Exception("Wrong mode, possible values are GS, LOC, EX, SPEC, SUM.")
+
+    # integrals, grid and JK are shared by all stages
+    ctx = KSContext(mol,func)
 
     if "GS" in mode:
-        DFTGroundState(mol,func,PREFIX=psi4.core.get_local_option("PSIXAS","PREFIX"))
+        DFTGroundState(mol,func,PREFIX=psi4.core.get_local_option("PSIXAS","PREFIX"),CTX=ctx)
 
     if "LOC" in mode:
         loc_sub = np.array(psi4.core.get_local_option("PSIXAS","LOC_SUB"),dtype=np.int)
-        wfn     = psi4.core.Wavefunction.build(mol,psi4.core.get_global_option('BASIS'))
-
-        nbf = wfn.nso()
-        sup = psi4.driver.dft.build_superfunctional(func, False)[0]
-        sup.set_deriv(2)
-        sup.allocate()
+        wfn     = ctx.wfn
 
-        uhf   = psi4.core.UHF(wfn,sup)
+        nbf = ctx.nbf
+        uhf = ctx.build_uhf()
 
         prefix = psi4.core.get_local_option("PSIXAS","PREFIX")
-        Ca = np.load(prefix+"_gsorbs.npz")["Ca"]
-        Cb = np.load(prefix+"_gsorbs.npz")["Cb"]
-        occa = np.load(prefix+"_gsorbs.npz")["occa"]
-        occb = np.load(prefix+"_gsorbs.npz")["occb"]
-        epsa = np.load(prefix+"_gsorbs.npz")["epsa"]
-        epsb = np.load(prefix+"_gsorbs.npz")["epsb"]
+        gsorbs = OrbitalStore(prefix+"_gsorbs.npz")
+        Ca = np.array(gsorbs.C("a"))
+        Cb = np.array(gsorbs.C("b"))
+        occa = gsorbs.occ("a")
+        occb = gsorbs.occ("b")
+        epsa = gsorbs.eps("a")
+        epsb = gsorbs.eps("b")
 
 
         locCa = psi4.core.Matrix(wfn.nso(),len(loc_sub))
@@ -93,10 +100,21 @@ def run_psixas(name, **kwargs):
         LocalA.localize()
         LocalB.localize()
 
+        Da = (Ca*occa) @ Ca.T
+        Db = (Cb*occb) @ Cb.T
         Ca[:,loc_sub] = LocalA.L
         Cb[:,loc_sub] = LocalB.L
 
-        np.savez(prefix+'_gsorbs',Ca=Ca,Cb=Cb,occa=occa,occb=occb)
+        # energy and warm start state (Fock, J/K) depend on the density only,
+        # they stay valid as long as LOC_SUB does not mix occupations
+        extra = {k : np.array(gsorbs[k]) for k in gsorbs.keys()
+                 if k not in ["Ca","Cb","occa","occb","epsa","epsb"]}
+        if not (np.allclose((Ca*occa) @ Ca.T,Da) and np.allclose((Cb*occb) @ Cb.T,Db)):
+            psi4.core.print_out("LOC_SUB mixes occupied and virtual orbitals, ground state Fock matrices dropped\n")
+            extra = {k : v for k,v in extra.items() if k in ["energy"] or k.startswith("orb_")}
+            ctx.gs_state = None
+
+        writeOrbitals(prefix+'_gsorbs.npz',Ca,Cb,occa,occb,epsa,epsb,**extra)
         psi4.core.print_out("Localized Orbitals written")
 
         OCCA = psi4.core.Vector(nbf)
@@ -133,16 +151,49 @@ def run_psixas(name, **kwargs):
             raise Exception("Input arrays have inconsistent length"+" ".join(str(lens)))
         for i in range(len(orbs)):
             orbitals.append({"orb" : orbs[i],"spin": spin[i].lower(),"occ" : occs[i], "frz" : freeze[i]=="T","DoOvl":ovl[i] == "T" })
-        DFTExcitedState(mol,func,orbitals)
+
+        sites = psi4.core.get_local_option("PSIXAS","SITES")
+        if len(sites) > 0:
+            # one excited state (and spectrum) per site, run in parallel
+            RunSites(mol,func,orbitals,sites,CTX=ctx,SPEC=("SPEC" in mode))
+            mode = [x for x in mode if x != "SPEC"]
+        else:
+            DFTExcitedState(mol,func,orbitals,CTX=ctx)
 
     if ("SPEC" in mode):
-        CalcSpec(mol,func)
+        CalcSpec(mol,func,CTX=ctx)
+
+    if ("SUM" in mode):
+        prefix = psi4.core.get_local_option("PSIXAS","PREFIX")
+        fname  = prefix+"_sites.spectrum"
+        if not os.path.isfile(fname):
+            fname = prefix+".spectrum"
+        grid = psi4.core.get_local_option("PSIXAS","SPEC_GRID")
+        if len(grid) == 3:
+            grid = np.linspace(grid[0],grid[1],int(grid[2]))
+        elif len(grid) == 0:
+            grid = None
+        else:
+            raise Exception("SPEC_GRID needs three entries: [Emin, Emax, Npts]")
+        shape = psi4.core.get_local_option("PSIXAS","SPEC_SHAPE")
+        fwhmL = psi4.core.get_local_option("PSIXAS","SPEC_FWHM_L") if shape == "VOIGT" else None
+        res = AggregateSpectra(fname,grid,
+                               align=psi4.core.get_local_option("PSIXAS","SPEC_ALIGN"),
+                               resolved=True,
+                               fwhm=psi4.core.get_local_option("PSIXAS","SPEC_FWHM"),
+                               shape=shape,fwhmL=fwhmL)
+        atomicSavez(prefix+"_sum.npz",grid=res["grid"],total=res["total"],sites=np.array(res["sites"]),
+                    site_spectra=res["site_spectra"],En=res["En"],f=res["f"],block=res["block"])
+        psi4.core.print_out("\n{} sites of {} aggregated, {}_sum.npz written.. \n\n".format(len(res["sites"]),fname,prefix))
+
 
 
 
 
 
 
+    # let background CFOUR exports finish
+    waitExports()
 
     #psixas_wfn = psi4.core.plugin('psixas.so', wfn)
 
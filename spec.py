@@ -1,26 +1,33 @@
 import numpy as np
-import pdb
+import os
 import psi4
-import pickle
+import time
+from .kscontext import KSContext
+from .ksorbs import OrbitalStore
+from .kslinalg import transitionDipoles,oscillatorStrengths
+from .ksspectrum import writeSpectra
 
 
-def CalcSpec(mol,func):
+def CalcSpec(mol,func,**kwargs):
     psi4.core.print_out("\n\nX-Ray Absorption Spectrum Calculation:\n"+38*"="+"\n\n")
-    prefix = psi4.core.get_local_option("PSIXAS","PREFIX")
+    prefix = kwargs.get("PREFIX",psi4.core.get_local_option("PSIXAS","PREFIX"))
+    gsprefix = kwargs.get("GSPREFIX",prefix)
 
 
     psi4.core.print_out("Using orbitals, occupations from file: {}  \n".format(prefix+"_exorbs.npz"))
 
-    Ca = np.load(prefix+"_exorbs.npz")["Ca"]
-    Cb = np.load(prefix+"_exorbs.npz")["Cb"]
+    exorbs = OrbitalStore(prefix+"_exorbs.npz")
 
-    occa = np.load(prefix+"_exorbs.npz")["occa"]
-    occb = np.load(prefix+"_exorbs.npz")["occb"]
+    Ca = exorbs.C("a")
+    Cb = exorbs.C("b")
 
-    epsa = np.load(prefix+"_exorbs.npz")["epsa"]
-    epsb = np.load(prefix+"_exorbs.npz")["epsb"]
+    occa = exorbs.occ("a")
+    occb = exorbs.occ("b")
 
-    orbitals = np.load(prefix+"_exorbs.npz", allow_pickle=True)["orbitals"]
+    epsa = exorbs.eps("a")
+    epsb = exorbs.eps("b")
+
+    orbitals = exorbs.orbitals()
 
 
     psi4.core.print_out("Occupation pattern: \n")
@@ -28,40 +35,69 @@ def CalcSpec(mol,func):
     printOccupation("Alpha",occa,15)
     printOccupation("Beta ",occb,15)
 
-    #psi4.core.be_quiet()
-    wfn   = psi4.core.Wavefunction.build(mol,psi4.core.get_global_option('BASIS'))
-    mints = psi4.core.MintsHelper(wfn.basisset())
-    psi4.core.reopen_outfile()
-
-    D = mints.ao_dipole()
-    Dx,Dy,Dz = np.asarray(D[0]),np.asarray(D[1]),np.asarray(D[2])
-
-    spec = {}
-
-    if ("b" in [x['spin'] for x in orbitals]):
-        psi4.core.print_out("\nBETA orbitals")
-        orbI = ([c for c,x in enumerate(occb) if x != 1.0][0])
-        psi4.core.print_out("\nInitial Orbital: {:d}".format(orbI))
-        Ci = Cb[orbI]
-        orbF = ([c for c,x in enumerate(occb) if (x != 1.0) and (c!=orbI)])
+    ctx = kwargs.get("CTX")
+    if ctx is None:
+        ctx = KSContext(mol,func)
+
+    D = ctx.dipole
+
+    spec   = {}
+    blocks = []
+    meta   = {"site"   : kwargs.get("SITE",prefix),
+              "prefix" : prefix,
+              "func"   : func,
+              "basis"  : psi4.core.get_global_option('BASIS'),
+              "date"   : time.strftime("%Y-%m-%d %H:%M:%S")}
+    if "energy" in exorbs:
+        meta["energy"] = float(exorbs["energy"])
+    gsE = groundStateEnergy(gsprefix)
+    if gsE is not None:
+        meta["gs_energy"] = gsE
+
+    for spin,C,occ,eps in [("a",Ca,occa,epsa),("b",Cb,occb,epsb)]:
+        orbI = [i["orb"] for i in orbitals if (i["spin"]==spin) and (occ[i["orb"]] != 1.0)]
+        if len(orbI) == 0:
+            continue
+        psi4.core.print_out("\n{} orbitals".format("ALPHA" if spin=="a" else "BETA"))
+        psi4.core.print_out("\nInitial Orbitals: {}".format(str(orbI)))
+        orbF = [c for c,x in enumerate(occ) if (x != 1.0) and (c not in orbI)]
         psi4.core.print_out("\nFinal Orbitals: {} \n\n".format(str(orbF)))
-        Cf = Cb[orbF]
-
-        Mx = Cb.T @ Dx @ Cb
-        My = Cb.T @ Dy @ Cb
-        Mz = Cb.T @ Dz @ Cb
-
-        spec["En"] = epsb[orbF] - epsb[orbI]
-        spec["Dx"] = Mx[orbI,orbF]
-        spec["Dy"] = My[orbI,orbF]
-        spec["Dz"] = Mz[orbI,orbF]
-
-        with open(prefix+'_b.spectrum', 'wb') as handle:
-            pickle.dump(spec, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        psi4.core.print_out(("\n{}"+"_b.spectrum written.. \n\n").format(prefix))
 
-    if ("a" in [x['spin'] for x in orbitals]):
-        print ("ALFA orbitals")
+        M  = transitionDipoles(C,D,orbI,orbF)
+        En = eps[orbF][None,:] - eps[orbI][:,None]
+
+        # one stick per (initial, final) pair
+        spec[spin] = {"En"   : En.ravel(),
+                      "Dx"   : M[0].ravel(),
+                      "Dy"   : M[1].ravel(),
+                      "Dz"   : M[2].ravel(),
+                      "f"    : oscillatorStrengths(En,M).ravel(),
+                      "orbI" : np.repeat(orbI,len(orbF)),
+                      "orbF" : np.tile(orbF,len(orbI)),
+                      "epsI" : np.repeat(eps[orbI],len(orbF))}
+
+        blocks.append((spec[spin],dict(meta,spin=spin)))
+
+    writeSpectra(prefix+'.spectrum',blocks)
+    psi4.core.print_out("\n{}.spectrum written.. \n\n".format(prefix))
+
+    return spec
+
+def groundStateEnergy(gsprefix):
+    """
+    Ground state energy: the GS ENERGY of this psi4 session, otherwise the
+    energy stored in GSPREFIX_gsorbs.npz (ground state of an earlier run or
+    of the parent of a spawned site worker), None if neither exists
+    """
+    if psi4.core.has_scalar_variable('GS ENERGY'):
+        gsE = psi4.core.scalar_variable('GS ENERGY')
+        if gsE != 0.0:
+            return gsE
+    if os.path.isfile(gsprefix+"_gsorbs.npz"):
+        gsorbs = OrbitalStore(gsprefix+"_gsorbs.npz")
+        if "energy" in gsorbs:
+            return float(gsorbs["energy"])
+    return None
 
 def printOccupation(title,occs,width):
     psi4.core.print_out("\n{}: \n".format(title))